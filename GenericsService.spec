@@ -60,6 +60,47 @@ module GenericsService {
   /* count_attribute_value: return count of each attribute value for a given attribute*/
   funcdef count_attribute_value(AttriCountParams params) returns(AttriCountReturn returnVal) authentication required;
 
+  /*
+    attribute_names: names of attributes
+    dimension: 'row' or 'col', 'row' by default
+    row_attribute_query, col_attribute_query: count only the ids select_row_ids (or
+        select_col_ids for the 'col' dimension) returns for these queries. All ids by default.
+    cross_tabulations: lists of at least 2 attribute names to count combinations of values of
+  */
+  typedef structure {
+    obj_ref matrix_ref;
+    list<string> attribute_names;
+    string dimension;
+    mapping<string, list<string>> row_attribute_query;
+    mapping<string, list<string>> col_attribute_query;
+    list<list<string>> cross_tabulations;
+  } AttriValuesCountParams;
+
+  /*
+    attributes - the attribute names.
+    values - the combinations of values of the attributes held by ids, most common first.
+    counts - number of ids holding each combination of values.
+  */
+  typedef structure {
+    list<string> attributes;
+    list<list<string>> values;
+    list<int> counts;
+  } AttriCrossTabulation;
+
+  /*
+    instance_count: number of ids counted
+    attributes_counts: count of each value of each attribute
+    cross_tabulations: counts of the combinations of values for each cross tabulation
+  */
+  typedef structure {
+    int instance_count;
+    mapping<string, mapping<string, int>> attributes_counts;
+    list<AttriCrossTabulation> cross_tabulations;
+  } AttriValuesCountReturn;
+
+  /* count_attribute_values: return count of each attribute value for several attributes*/
+  funcdef count_attribute_values(AttriValuesCountParams params) returns(AttriValuesCountReturn returnVal) authentication required;
+
 
   /* Input of the select_data function
     matrix_ref: generics matrix object reference
@@ -100,19 +141,38 @@ module GenericsService {
   /*
     ids: name of row/col ids. If empty, return all row ids.
     dimension: 'row' or 'col', 'row' by default
+    format: shape of the attributes, 'dict' by default.
+            'dict' - attributes of each id in attributes
+            'columns' - ids, attribute names and values of each attribute in attribute_columns
   */
   typedef structure {
     obj_ref matrix_ref;
     list<string> ids;
     string dimension;
+    string format;
   } FetchAttriParams;
 
+  /*
+    Attributes of a list of ids held by columns.
+
+    ids - the row/col ids.
+    attributes - the attribute names.
+    values - the values of each attribute for every id, indexed as: values[attribute][id]
+  */
+  typedef structure {
+    list<string> ids;
+    list<string> attributes;
+    list<list<string>> values;
+  } AttributeColumns;
+
   /* attributes in dict format
     e.g.
     {'PB-Low-5': {'IGSN': 'IEAWH0001'}}
+    attribute_columns: the attributes for the columns format
   */
   typedef structure {
     mapping<string, mapping<string, string>> attributes;
+    AttributeColumns attribute_columns;
   } FetchAttriReturn;
 
   /* return non-empty attributes for given row/col ids */
@@ -121,11 +181,16 @@ module GenericsService {
   /*
     row_ids: name of target row ids. If empty, return all row ids.
     col_ids: name of target col ids. If empty, return all col ids.
+    format: encoding of the matrix values, 'json' by default.
+            'json' - values as a list of lists in data
+            'npy_base64' - values as a base64 encoded .npy array in binary_data
+            'arrow_ipc_base64' - values as a base64 encoded Arrow IPC stream in binary_data
   */
   typedef structure {
     obj_ref matrix_ref;
     list<string> row_ids;
     list<string> col_ids;
+    string format;
   } FetchDataByIDParams;
 
   /*
@@ -147,21 +212,53 @@ module GenericsService {
     list<list<float>> values;
   } FloatMatrix2D;
 
+  /*
+    A 2D matrix with its values in a binary encoding, ids are sent as lists.
+
+    row_ids - unique ids for rows.
+    col_ids - unique ids for columns.
+    format - 'npy_base64' or 'arrow_ipc_base64'
+    values - base64 encoded values.
+             npy_base64: a float64 array of shape (n_rows, n_cols), missing values are NaN.
+             arrow_ipc_base64: a stream of one record batch with a float64 column named by
+                               each col id, missing values are null.
+  */
+  typedef structure {
+    list<string> row_ids;
+    list<string> col_ids;
+    string format;
+    string values;
+  } BinaryMatrix2D;
+
+  /*
+    data: the matrix for the json format
+    binary_data: the matrix for binary formats
+  */
   typedef structure {
     FloatMatrix2D data;
+    BinaryMatrix2D binary_data;
   } FetchDataByIDReturn;
 
   /* return matrix data for specific row/col ids */
   funcdef fetch_data_by_ids(FetchDataByIDParams params) returns(FetchDataByIDReturn returnVal) authentication required;
 
+  /*
+    format: encoding of the matrix values as for fetch_data_by_ids, 'json' by default.
+  */
   typedef structure {
     obj_ref matrix_ref;
+    string format;
   } FetchAllParams;
 
+  /*
+    data: the matrix for the json format
+    binary_data: the matrix for binary formats
+  */
   typedef structure {
     mapping<string, mapping<string, string>> row_attributes;
     mapping<string, mapping<string, string>> col_attributes;
     FloatMatrix2D data;
+    BinaryMatrix2D binary_data;
   } FetchAllReturn;
 
   /* return all matrix data including attribute information */
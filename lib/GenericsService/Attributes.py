@@ -0,0 +1,226 @@
+import numpy as np
+
+from GenericsService.ObjectCache import estimate_size
+
+# code of an instance having no value for an attribute
+MISSING_CODE = -1
+
+# shapes of the attributes returned by fetch_attributes
+ATTRIBUTE_FORMATS = ['dict', 'columns']
+
+
+def _value_lookup(uniques):
+    lookup = dict()
+    for code, value in enumerate(uniques):
+        try:
+            lookup.setdefault(value, code)
+        except TypeError:
+            # unhashable values can never match a query
+            pass
+    return lookup
+
+
+def _countable(value):
+    # None and unhashable values are not counted
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return value is not None
+
+
+def _encode_column(rows, pos):
+    """
+    _encode_column: the codes and unique values of the values at position pos of rows
+    """
+    try:
+        lookup = dict()
+        codes = [lookup.setdefault(row[pos], len(lookup)) for row in rows]
+        return np.array(codes, dtype=np.int32), list(lookup)
+    except (IndexError, TypeError):
+        pass
+
+    # rows without a value at pos or with unhashable values
+    lookup = dict()
+    uniques = list()
+    codes = list()
+    for row in rows:
+        if pos >= len(row):
+            codes.append(MISSING_CODE)
+            continue
+        value = row[pos]
+        try:
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(uniques)
+                uniques.append(value)
+        except TypeError:
+            code = len(uniques)
+            uniques.append(value)
+        codes.append(code)
+    return np.array(codes, dtype=np.int32), uniques
+
+
+class AttributeIndex(object):
+    '''
+    An AttributeMapping held as dictionary encoded columns.
+
+    Each attribute is an array of the integer code of every instance's value and the list of
+    unique values the codes refer to, instance ids are kept once. Queries, counts and projections
+    run on the codes. Instances without a value for an attribute have MISSING_CODE.
+    '''
+
+    def __init__(self, ids, attribute_names, columns):
+        self.ids = ids
+        self.attribute_names = attribute_names
+        self._columns = dict(zip(attribute_names, columns))
+        self._lookups = {name: _value_lookup(uniques)
+                         for name, (_, uniques) in self._columns.items()}
+        self._id_positions = {id_: pos for pos, id_ in enumerate(ids)}
+
+    @classmethod
+    def from_instances(cls, instances, attribute_names):
+        """
+        from_instances: build the index of a mapping of instance ids to their attribute values
+        """
+        rows = list(instances.values())
+        return cls(list(instances), attribute_names,
+                   [_encode_column(rows, pos) for pos in range(len(attribute_names))])
+
+    @classmethod
+    def from_data(cls, attri_data):
+        """
+        from_data: build the index of AttributeMapping data
+        """
+        return cls.from_instances(attri_data['instances'],
+                                  [x['attribute'] for x in attri_data['attributes']])
+
+    @property
+    def nbytes(self):
+        # ids are estimated at 64 bytes each including their position entry
+        return 64 * len(self.ids) + sum(codes.nbytes + estimate_size(uniques)
+                                        for codes, uniques in self._columns.values())
+
+    def column(self, name):
+        """
+        column: the codes and unique values of an attribute
+        """
+        return self._columns[name]
+
+    def values(self, name, positions):
+        """
+        values: the values of an attribute for the instances at the given positions
+        """
+        codes, uniques = self._columns[name]
+        return [uniques[code] if code != MISSING_CODE else None
+                for code in codes[positions].tolist()]
+
+    def positions(self, ids):
+        """
+        positions: positions of the given instance ids found in the mapping, in mapping order
+        """
+        return sorted({self._id_positions[id_] for id_ in ids if id_ in self._id_positions})
+
+    def to_dict(self, positions):
+        """
+        to_dict: the attribute values of the instances at the given positions by instance id
+        """
+        columns = [self.values(name, positions) for name in self.attribute_names]
+        rows = zip(*columns) if columns else [()] * len(positions)
+        return {self.ids[pos]: dict(zip(self.attribute_names, row_values))
+                for pos, row_values in zip(positions, rows)}
+
+    def to_columns(self, positions):
+        """
+        to_columns: the ids of the instances at the given positions, the attribute names and for
+                    each attribute the values of those instances
+        """
+        return {'ids': [self.ids[pos] for pos in positions],
+                'attributes': list(self.attribute_names),
+                'values': [self.values(name, positions) for name in self.attribute_names]}
+
+    def _matches(self, name, values):
+        codes, uniques = self._columns[name]
+        lookup = self._lookups[name]
+        # one more entry so that MISSING_CODE never matches
+        table = np.zeros(len(uniques) + 1, dtype=bool)
+        for value in values:
+            try:
+                code = lookup.get(value)
+            except TypeError:
+                continue
+            if code is not None:
+                table[code] = True
+        return table[codes]
+
+    def select(self, query):
+        """
+        select: ids of instances matching any of the given values for every queried attribute
+
+        e.g. query = {'chemical_type': ['specific', 'exometabolite'], 'units': ['mg/l']}
+        """
+        for name in query:
+            if name not in self._columns:
+                raise ValueError('Attribute does not contain {}'.format(name))
+
+        selected = np.ones(len(self.ids), dtype=bool)
+        for name, values in query.items():
+            selected &= self._matches(name, values)
+            if not selected.any():
+                return []
+
+        return [self.ids[pos] for pos in np.flatnonzero(selected)]
+
+    def value_counts(self, name, positions=None):
+        """
+        value_counts: number of instances for each value of an attribute, most common first
+
+        only the instances at the given positions are counted if positions are given
+        """
+        codes, uniques = self._columns[name]
+        if positions is not None:
+            codes = codes[positions]
+        counts = np.bincount(codes[codes != MISSING_CODE], minlength=len(uniques))
+        value_counts = dict()
+        # a stable sort keeps values with equal counts in order of first appearance
+        for code in np.argsort(-counts, kind='stable').tolist():
+            value = uniques[code]
+            if counts[code] and _countable(value):
+                value_counts.setdefault(value, int(counts[code]))
+        return value_counts
+
+    def cross_counts(self, names, positions=None):
+        """
+        cross_counts: the combinations of values of several attributes held by instances and
+                      their number of instances, most common first
+
+        only the instances at the given positions are counted if positions are given
+        """
+        codes = np.stack([self._columns[name][0] for name in names], axis=1)
+        if positions is not None:
+            codes = codes[positions]
+        codes = codes[(codes != MISSING_CODE).all(axis=1)]
+        try:
+            # each combination of codes as one integer, much faster to count than rows of codes
+            shape = [len(self._columns[name][1]) for name in names]
+            keys, first, counts = np.unique(np.ravel_multi_index(codes.T, shape),
+                                            return_index=True, return_counts=True)
+            combinations = np.stack(np.unravel_index(keys, shape), axis=1)
+        except ValueError:
+            # more combinations than fit in an integer
+            combinations, first, counts = np.unique(codes, axis=0, return_index=True,
+                                                    return_counts=True)
+
+        values = list()
+        value_counts = list()
+        # combinations with equal counts are kept in order of first appearance
+        for pos in np.lexsort((first, -counts)).tolist():
+            combination = [self._columns[name][1][code]
+                           for name, code in zip(names, combinations[pos].tolist())]
+            if all(map(_countable, combination)):
+                values.append(combination)
+                value_counts.append(int(counts[pos]))
+        return values, value_counts
+
+    def __contains__(self, name):
+        return name in self._columns
@@ -0,0 +1,151 @@
+import itertools
+import threading
+import zlib
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+DEFAULT_ENCODINGS = 'zstd,gzip,deflate'
+DEFAULT_MIN_KB = 16
+DEFAULT_LEVEL = 1
+DEFAULT_ZSTD_LEVEL = 3
+
+
+def parse_accept_encoding(accept_encoding):
+    """
+    parse_accept_encoding: map each content coding of an Accept-Encoding header to its q value
+    """
+    accepted = dict()
+    for item in (accept_encoding or '').split(','):
+        parts = item.split(';')
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+class ResponseCompressor(object):
+    '''
+    Compresses response bodies with the content coding preferred by the client.
+
+    Bodies are iterables of bytes chunks and are compressed chunk by chunk, so streamed
+    responses stay streamed. Bodies smaller than min_bytes are sent as they are.
+    '''
+
+    def __init__(self, encodings, min_bytes, level=DEFAULT_LEVEL, zstd_level=DEFAULT_ZSTD_LEVEL):
+        self.encodings = [encoding for encoding in encodings
+                          if encoding in ('gzip', 'deflate') or (encoding == 'zstd' and zstd)]
+        self.min_bytes = min_bytes
+        self.level = level
+        self.zstd_level = zstd_level
+        self._lock = threading.Lock()
+        self._stats = {encoding: {'responses': 0, 'bytes_in': 0, 'bytes_out': 0}
+                       for encoding in self.encodings}
+        self.uncompressed = 0
+
+    def negotiate(self, accept_encoding):
+        """
+        negotiate: the content coding to use for a request's Accept-Encoding header, or None
+        """
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_q = None, 0.0
+        for encoding in self.encodings:
+            q = accepted.get(encoding, accepted.get('*', 0.0))
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def _compressobj(self, encoding):
+        if encoding == 'zstd':
+            return zstd.ZstdCompressor(level=self.zstd_level).compressobj()
+        # wbits 31 writes a gzip header and trailer, 15 the zlib format of http deflate
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+
+    def _iter_compressed(self, chunks, encoding):
+        compressor = self._compressobj(encoding)
+        bytes_in = bytes_out = 0
+        try:
+            for chunk in chunks:
+                bytes_in += len(chunk)
+                compressed = compressor.compress(chunk)
+                if compressed:
+                    bytes_out += len(compressed)
+                    yield compressed
+            compressed = compressor.flush()
+            bytes_out += len(compressed)
+            yield compressed
+        finally:
+            with self._lock:
+                stats = self._stats[encoding]
+                stats['responses'] += 1
+                stats['bytes_in'] += bytes_in
+                stats['bytes_out'] += bytes_out
+
+    def compress(self, chunks, encoding):
+        """
+        compress: compress a response body with the given content coding
+
+        returns the body and the content coding applied, None if the body is below min_bytes.
+        A list of chunks is compressed at once into a list, other iterables are compressed
+        lazily as they are consumed.
+        """
+        if isinstance(chunks, list):
+            if sum(len(chunk) for chunk in chunks) < self.min_bytes:
+                with self._lock:
+                    self.uncompressed += 1
+                return chunks, None
+            return list(self._iter_compressed(chunks, encoding)), encoding
+
+        chunks = iter(chunks)
+        head = list()
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self.min_bytes:
+                return self._iter_compressed(itertools.chain(head, chunks), encoding), encoding
+        with self._lock:
+            self.uncompressed += 1
+        return head, None
+
+    def stats(self):
+        with self._lock:
+            stats = {encoding: dict(encoding_stats,
+                                    ratio=(encoding_stats['bytes_in'] / encoding_stats['bytes_out']
+                                           if encoding_stats['bytes_out'] else 0.0))
+                     for encoding, encoding_stats in self._stats.items()}
+            stats['uncompressed_responses'] = self.uncompressed
+            return stats
+
+
+_response_compressor = None
+_response_compressor_lock = threading.Lock()
+
+
+def get_response_compressor(config):
+    """
+    get_response_compressor: return the process-wide response compressor, creating it on first use
+    """
+    global _response_compressor
+    with _response_compressor_lock:
+        if _response_compressor is None:
+            config = config or dict()
+            encodings = config.get('compression-encodings', DEFAULT_ENCODINGS)
+            _response_compressor = ResponseCompressor(
+                [encoding.strip().lower() for encoding in encodings.split(',')
+                 if encoding.strip()],
+                int(config.get('compression-min-kb', DEFAULT_MIN_KB)) * 1024,
+                int(config.get('compression-level', DEFAULT_LEVEL)),
+                int(config.get('zstd-compression-level', DEFAULT_ZSTD_LEVEL)))
+        return _response_compressor
@@ -1,65 +1,97 @@
+import hashlib
 import json
 import logging
 import re
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-import pandas as pd
 import numpy as np
+import pandas as pd
 
 from installed_clients.WorkspaceClient import Workspace as workspaceService
+from installed_clients.baseclient import BaseClient
+from GenericsService.Attributes import ATTRIBUTE_FORMATS, AttributeIndex
+from GenericsService.Matrix import (MATRIX_FORMATS, Matrix, MatrixValues, ValuesBuilder,
+                                    encode_binary_values)
+from GenericsService.MatrixStore import get_matrix_store
+from GenericsService.ObjectCache import (ObjectScope, estimate_size, get_inflight_downloads,
+                                         get_object_cache)
+from GenericsService.SharedCache import get_shared_cache
+from GenericsService.TypeSpec import SpecModel, get_type_cache
 
 GENERICS_TYPES = ['FloatMatrix2D', 'Attribute']  # add case in convert_data for each additional type
 
+# object paths read from AttributeMapping objects
+ATTRIBUTE_PATHS = ['instances', 'attributes']
+# ijson prefix of the values of the FloatMatrix2D data of objects returned by get_objects2
+MATRIX_VALUES_PREFIX = 'result.item.data.item.data.data.values'
+DEFAULT_OBJECT_INFO_TTL = 60
+# a workspace reference to a fixed version of an object, wsid/objid/ver. Refs by name are not
+# fixed, workspaces and objects can be renamed
+VERSIONED_REF = re.compile(r'\d+/\d+/\d+')
+DEFAULT_DOWNLOAD_THREADS = 4
+DEFAULT_STREAM_DECODE_MIN_MB = 64
+
+_download_executor = None
+_download_executor_lock = threading.Lock()
+
+
+def get_download_executor(config):
+    """
+    get_download_executor: return the process-wide pool of threads downloading objects
+    """
+    global _download_executor
+    with _download_executor_lock:
+        if _download_executor is None:
+            _download_executor = ThreadPoolExecutor(
+                max_workers=int(config.get('download-threads', DEFAULT_DOWNLOAD_THREADS)))
+        return _download_executor
 
-class Fetch:
-    def _find_between(self, s, start, end):
-        """
-        _find_between: find string in between start and end
-        """
-
-        return re.search('{}(.*){}'.format(start, end), s).group(1)
 
+class Fetch:
     def _find_type_spec(self, obj_type):
         """
-        _find_type_spec: find body spec of type
+        _find_type_spec: find the parsed spec that defines a type and the name of the type
         """
-        obj_type_name = self._find_between(obj_type, '\.', '\-')
+        module_name, type_name = obj_type.split('-')[0].split('.')
 
         type_info = self.wsClient.get_type_info(obj_type)
-        type_spec = type_info.get('spec_def')
-
-        type_spec_list = type_spec.split(obj_type_name + ';')
-        obj_type_spec = type_spec_list[0].split('structure')[-1]
-        logging.debug('Found spec for {}\n{}\n'.format(obj_type, obj_type_spec))
-
-        return obj_type_spec
+        module_ver = max(type_info.get('module_vers') or [None])
+
+        spec_model = self.type_cache.get_module_model(module_name, module_ver)
+        if spec_model is None:
+            spec_model = SpecModel(type_info.get('spec_def') or '')
+            unresolved_names = spec_model.unresolved_names(type_name) - set(GENERICS_TYPES)
+            if unresolved_names:
+                # the type uses typedefs of its module that are not part of its own spec
+                logging.info('Retrieving module spec to resolve {}'.format(unresolved_names))
+                module_info = self.wsClient.get_module_info({'mod': module_name,
+                                                             'ver': module_ver})
+                spec_model = SpecModel(module_info['spec'])
+                self.type_cache.add_module_model(module_name, module_ver, spec_model)
+
+        return spec_model, type_name
 
     def _find_generics_type(self, obj_type):
         """
         _find_generics_type: try to find generics type in an object
         """
+        generics_module = self.type_cache.get(obj_type)
+        if generics_module is not None:
+            logging.debug('Found cached generics type for {}'.format(obj_type))
+            return generics_module
 
         logging.info('Start finding generics type and name')
 
-        obj_type_spec = self._find_type_spec(obj_type)
+        spec_model, type_name = self._find_type_spec(obj_type)
+        generics_module = spec_model.find_generics_fields(type_name, GENERICS_TYPES)
 
-        if not obj_type_spec:
-            raise ValueError('Cannot retrieve spec for: {}'.format(obj_type))
-
-        generics_types = [generics_type for generics_type in GENERICS_TYPES
-                          if generics_type in obj_type_spec]
-
-        if not generics_types:
-            error_msg = 'Cannot find generics type in spec:\n{}\n'.format(obj_type_spec)
-            raise ValueError(error_msg)
-
-        generics_module = dict()
-        for generics_type in generics_types:
-            for item in obj_type_spec.split(generics_type)[1:]:
-                generics_type_name = item.split(';')[0].strip().split(' ')[-1].strip()
-                generics_module.update({generics_type_name: generics_type})
+        if not generics_module:
+            raise ValueError('Cannot find generics type in spec of {}'.format(obj_type))
 
         logging.debug('Found generics type:\n{}\n'.format(generics_module))
+        self.type_cache.add(obj_type, generics_module)
 
         return generics_module
 
@@ -75,10 +107,7 @@ class Fetch:
 
         if data_types == ['FloatMatrix2D']:
             key = list(generics_module.keys())[list(generics_module.values()).index('FloatMatrix2D')]
-            values = data[key]['values']
-            index = data[key]['row_ids']
-            columns = data[key]['col_ids']
-            df = pd.DataFrame(values, index=index, columns=columns)
+            df = Matrix.from_data(data[key]).to_dataframe()
         elif data_types == ['Attribute']:
             values = data['instances'].values()
             index = data['instances'].keys()
@@ -102,15 +131,264 @@ class Fetch:
 
         return data_matrix
 
-    def _retrieve_object(self, obj_ref):
-        logging.info('Start retrieving object {}'.format(obj_ref))
-        obj_source = self.wsClient.get_objects2(
-            {"objects": [{'ref': obj_ref}]})['data'][0]
+    def _resolve_object_infos(self, obj_refs):
+        """
+        _resolve_object_infos: check access to objects and resolve them to fixed versions
+        """
+        if self.shared_cache is None:
+            return self.wsClient.get_object_info3(
+                {'objects': [{'ref': obj_ref} for obj_ref in obj_refs]})['infos']
+
+        # infos are shared between workers by token, so access checked for a token in one
+        # worker holds in all workers for object-info-ttl seconds. Only wsid/objid/ver refs are
+        # shared, other refs can resolve to a newer version or another object at any time
+        info_keys = ['info:{}:{}'.format(self.token_hash, obj_ref)
+                     if VERSIONED_REF.fullmatch(obj_ref) else None for obj_ref in obj_refs]
+        obj_infos = [self.shared_cache.get(info_key) if info_key else None
+                     for info_key in info_keys]
+        missing = [pos for pos, obj_info in enumerate(obj_infos) if obj_info is None]
+        if missing:
+            missing_infos = self.wsClient.get_object_info3(
+                {'objects': [{'ref': obj_refs[pos]} for pos in missing]})['infos']
+            for pos, obj_info in zip(missing, missing_infos):
+                obj_infos[pos] = obj_info
+                if info_keys[pos]:
+                    self.shared_cache.set(info_keys[pos], obj_info, self.object_info_ttl)
+        return obj_infos
+
+    @staticmethod
+    def _covers(paths, included):
+        """
+        _covers: check whether an object subset retrieved with paths contains the included paths
+        """
+        if paths is None:
+            return True
+        if included is None:
+            return False
+        return all(any(path == inc or inc.startswith(path + '/') for path in paths)
+                   for inc in included)
+
+    def _canonical_paths(self, included, decoder):
+        """
+        _canonical_paths: the sorted paths to retrieve objects with
+
+        objects kept in the matrix store are retrieved with one set of paths per decoder whenever
+        it holds the requested paths, so each object is downloaded and stored once
+        """
+        paths = tuple(sorted(set(included))) if included is not None else None
+        if decoder == self._decode_matrix:
+            store_paths = ('data',)
+        elif decoder == AttributeIndex.from_data:
+            store_paths = tuple(sorted(ATTRIBUTE_PATHS))
+        else:
+            return paths
+        return store_paths if self._covers(store_paths, paths) else paths
+
+    def _find_in_scope(self, obj_ref, included, decoder):
+        for (scope_ref, paths, scope_decoder), obj in self.object_scope.items():
+            if (scope_ref == obj_ref and scope_decoder == decoder and
+                    self._covers(paths, included)):
+                return obj
+        return None
+
+    @staticmethod
+    def _decode_matrix(matrix_data):
+        """
+        _decode_matrix: replace the FloatMatrix2D data of a matrix object with a Matrix
+        """
+        matrix_data = dict(matrix_data)
+        matrix_data['data'] = Matrix.from_data(matrix_data['data'])
+        return matrix_data
+
+    def _uses_matrix_store(self, decoder):
+        return self.matrix_store is not None and decoder in (self._decode_matrix,
+                                                             AttributeIndex.from_data)
+
+    def _find_info_in_scope(self, obj_ref):
+        for (scope_ref, _, _), (obj_info, _) in self.object_scope.items():
+            if scope_ref == obj_ref:
+                return obj_info
+        return None
 
-        obj_info = obj_source.get('info')
-        obj_data = obj_source.get('data')
+    def _retrieve_object_groups(self, groups):
+        """
+        _retrieve_object_groups: retrieve groups of objects with at most one workspace download
+                                 call per group, downloading the groups concurrently
+
+        groups: list of (obj_refs, included, decoder), see _retrieve_objects
 
-        return obj_info, obj_data
+        returns a list of the (object info, object data) of each group's refs
+        """
+        groups = [(obj_refs, self._canonical_paths(included, decoder), decoder)
+                  for obj_refs, included, decoder in groups]
+
+        # the scope is only locked to look up and add objects, requests of a batch needing the
+        # same object share its download through the downloads in progress
+        with self.object_scope.lock:
+            new_groups = list()
+            for obj_refs, paths, decoder in groups:
+                new_refs = [obj_ref for obj_ref in dict.fromkeys(obj_refs)
+                            if self._find_in_scope(obj_ref, paths, decoder) is None]
+                if new_refs:
+                    new_groups.append((new_refs, paths, decoder))
+
+        if new_groups:
+            for new_refs, paths, _ in new_groups:
+                logging.info('Start retrieving objects {} with paths {}'.format(new_refs, paths))
+
+            # always ask the workspace first so a cached object is only served to a token that
+            # is allowed to read it, objects already in the scope were checked
+            obj_infos = dict()
+            for obj_ref in dict.fromkeys(obj_ref for new_refs, _, _ in new_groups
+                                         for obj_ref in new_refs):
+                obj_infos[obj_ref] = self._find_info_in_scope(obj_ref)
+            unresolved = [obj_ref for obj_ref, obj_info in obj_infos.items()
+                          if obj_info is None]
+            if unresolved:
+                obj_infos.update(zip(unresolved, self._resolve_object_infos(unresolved)))
+
+            missing = dict()
+            obj_sizes = dict()
+            for new_refs, paths, decoder in new_groups:
+                for obj_ref in new_refs:
+                    obj_info = obj_infos[obj_ref]
+                    upa = '{}/{}/{}'.format(obj_info[6], obj_info[0], obj_info[4])
+                    obj_sizes[upa] = obj_info[9]
+                    # any cached entry holding the requested paths will do
+                    cached_keys = [(upa, cached_paths, decoder) for cached_paths
+                                   in self.object_cache.paths(upa, decoder)
+                                   if self._covers(cached_paths, paths)]
+                    obj_data = self.object_cache.get((upa, paths, decoder), *cached_keys)
+                    if obj_data is None and self._uses_matrix_store(decoder):
+                        obj_data = self.matrix_store.get((upa, paths))
+                        if obj_data is not None:
+                            self.object_cache.add((upa, paths, decoder), obj_data,
+                                                  estimate_size(obj_data))
+                    if obj_data is not None:
+                        logging.info('Found object {} in cache'.format(upa))
+                        self.object_scope[(obj_ref, paths, decoder)] = (obj_info, obj_data)
+                    else:
+                        missing.setdefault((upa, paths, decoder), []).append(obj_ref)
+
+            if missing:
+                # concurrent requests for the same objects share one download
+                downloads, started = self.inflight_downloads.join(missing)
+                if started:
+                    # the downloads are always finished, with the error they failed with if any,
+                    # so requests waiting for them never hang
+                    error = None
+                    try:
+                        results = self._download_groups(started, obj_sizes)
+                        not_returned = [key for key in started if key not in results]
+                        if not_returned:
+                            raise ValueError('Workspace did not return objects {}'.format(
+                                [upa for upa, _, _ in not_returned]))
+                        for key in started:
+                            downloads[key].result = results[key]
+                    except BaseException as e:
+                        error = e
+                        raise
+                    finally:
+                        self.inflight_downloads.finish(downloads, started, error)
+
+                for (upa, paths, decoder), refs in missing.items():
+                    obj_info, obj_data = self.inflight_downloads.wait(
+                        downloads[(upa, paths, decoder)])
+                    for obj_ref in refs:
+                        self.object_scope[(obj_ref, paths, decoder)] = (obj_info, obj_data)
+
+        return [[self._find_in_scope(obj_ref, paths, decoder) for obj_ref in obj_refs]
+                for obj_refs, paths, decoder in groups]
+
+    def _retrieve_objects(self, obj_refs, included=None, decoder=None):
+        """
+        _retrieve_objects: retrieve objects with at most one workspace download call
+
+        included: object paths to retrieve, e.g. ['data/row_ids']. Retrieve whole objects if None.
+        decoder: function converting the retrieved data, only the converted data is kept
+
+        objects are memoized for the lifetime of this request and cached across requests by
+        their resolved wsid/objid/ver reference, objects being downloaded by other requests are
+        waited for
+        """
+        return self._retrieve_object_groups([(obj_refs, included, decoder)])[0]
+
+    def _download_groups(self, keys, obj_sizes):
+        """
+        _download_groups: download objects by their (resolved reference, paths, decoder) keys
+
+        obj_sizes: the serialized size of each object by resolved reference, see object_info[9]
+
+        objects sharing paths and decoder are downloaded with one workspace call, the calls run
+        concurrently. Returns a dict of each key to its object info and data
+        """
+        download_groups = dict()
+        for upa, paths, decoder in keys:
+            download_groups.setdefault((paths, decoder), []).append(upa)
+        download_groups = [(upas, paths, decoder, sum(obj_sizes[upa] for upa in upas))
+                           for (paths, decoder), upas in download_groups.items()]
+
+        futures = [self.download_executor.submit(self._download_objects, *download_group)
+                   for download_group in download_groups[1:]]
+        results = dict()
+        error = None
+        try:
+            results.update(self._download_objects(*download_groups[0]))
+        except Exception as e:
+            error = e
+        for future in futures:
+            try:
+                results.update(future.result())
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def _download_objects(self, upas, paths, decoder, size=0):
+        """
+        _download_objects: download objects by their resolved references and cache them
+
+        size: the serialized size of the objects, matrices at least stream-decode-min-mb large are
+              decoded as the response arrives
+
+        returns a dict of the (resolved reference, paths, decoder) key of each object to its object
+        info and data
+        """
+        object_specs = list()
+        for upa in upas:
+            object_spec = {'ref': upa}
+            if paths is not None:
+                object_spec['included'] = list(paths)
+            object_specs.append(object_spec)
+        if decoder == self._decode_matrix and size >= self.stream_decode_bytes:
+            # the values are read into arrays as the response arrives and never held as lists of
+            # floats, which takes a fraction of the memory but about twice the time
+            obj_sources = self.wsStreamClient.call_method(
+                'Workspace.get_objects2', [{"objects": object_specs}],
+                stream_hooks={MATRIX_VALUES_PREFIX: ValuesBuilder})['data']
+        else:
+            obj_sources = self.wsClient.get_objects2({"objects": object_specs})['data']
+
+        results = dict()
+        for upa, obj_source in zip(upas, obj_sources):
+            obj_info = obj_source.get('info')
+            obj_data = obj_source.get('data')
+
+            if decoder is not None:
+                obj_data = decoder(obj_data)
+                if self._uses_matrix_store(decoder):
+                    # continue with the values mapped from the store so that this
+                    # worker shares them with the other workers
+                    obj_data = self.matrix_store.add((upa, paths), obj_data) or obj_data
+            # the size of what is kept in the cache, not of the object in the workspace
+            size = estimate_size(obj_data)
+            self.object_cache.add((upa, paths, decoder), obj_data, size)
+            results[(upa, paths, decoder)] = (obj_info, obj_data)
+        return results
+
+    def _retrieve_object(self, obj_ref, included=None, decoder=None):
+        return self._retrieve_objects([obj_ref], included, decoder)[0]
 
     def _retrieve_attribute(self, matrix_data, dimension):
         logging.info('Start retrieving {} attribute from Matrix'.format(dimension))
@@ -120,14 +398,39 @@ class Fetch:
         if not attribute_ref:
             raise ValueError('Matrix object does not have {} attribute mapping object'.format(
                 dimension))
-        _, attri_data = self._retrieve_object(attribute_ref)
+        _, attri_index = self._retrieve_object(attribute_ref, ATTRIBUTE_PATHS,
+                                               AttributeIndex.from_data)
+
+        return attri_index
 
-        values = attri_data['instances'].values()
-        index = attri_data['instances'].keys()
-        columns = [x['attribute'] for x in attri_data['attributes']]
-        df = pd.DataFrame(values, index=index, columns=columns)
+    def _retrieve_with_attributes(self, matrix_ref, included, decoder, dimensions):
+        """
+        _retrieve_with_attributes: retrieve a matrix object and the attribute mappings of the
+                                   given dimensions, downloading them concurrently
 
-        return df
+        returns the matrix data with its attribute mapping refs, the attribute mappings are then
+        served by _retrieve_attribute from the request's object scope
+        """
+        if not dimensions:
+            return self._retrieve_object(matrix_ref, included, decoder)[1]
+
+        # the mapping refs are read first, they are small and usually cached. The matrix is
+        # retrieved without them, with the paths other methods retrieve it with, so it is cached
+        # once
+        _, refs_data = self._retrieve_object(
+            matrix_ref, ['row_attributemapping_ref', 'col_attributemapping_ref'])
+        attribute_refs = [refs_data.get('{}_attributemapping_ref'.format(dimension))
+                          for dimension in dimensions]
+
+        (matrix_obj,), _ = self._retrieve_object_groups(
+            [([matrix_ref], included, decoder),
+             ([ref for ref in attribute_refs if ref], ATTRIBUTE_PATHS, AttributeIndex.from_data)])
+
+        matrix_data = dict(matrix_obj[1])
+        for ref_path in ('row_attributemapping_ref', 'col_attributemapping_ref'):
+            if ref_path in refs_data:
+                matrix_data[ref_path] = refs_data[ref_path]
+        return matrix_data
 
     @staticmethod
     def validate_params(params, expected, opt_param=set()):
@@ -143,25 +446,39 @@ class Fetch:
             if param not in defined_param:
                 logging.warning("Unexpected parameter {} supplied".format(param))
 
-    def _select_id_from_attri(self, attri_df, query):
-
-        # set True for all index
-        condition = pd.Series([True] * len(attri_df.index), index=attri_df.index)
-
-        for attri_name in query:
-            if attri_name not in attri_df:
-                raise ValueError('Attribute does not contain {}'.format(attri_name))
-            condition = condition & attri_df[attri_name].isin(query[attri_name])
+    @staticmethod
+    def _validate_matrix_format(params):
+        matrix_format = params.get('format') or 'json'
+        if matrix_format not in MATRIX_FORMATS:
+            raise ValueError('Unknown matrix format {}, expected one of {}'.format(
+                matrix_format, MATRIX_FORMATS))
+        return matrix_format
 
-        # select index with True value
-        selected_idx = condition[condition].index.to_list()
+    def _select_id_from_attri(self, attri_index, query):
 
-        return selected_idx
+        return attri_index.select(query)
 
     def __init__(self, config, context):
         self.ws_url = config["workspace-url"]
         self.scratch = config['scratch']
         self.wsClient = workspaceService(self.ws_url, token=context['token'])
+        # the generated Workspace client has no way to pass stream hooks, objects decoded as
+        # they arrive are retrieved with a base client of the workspace
+        self.wsStreamClient = BaseClient(self.ws_url, token=context['token'])
+        self.object_cache = get_object_cache(config)
+        self.shared_cache = get_shared_cache(config)
+        self.matrix_store = get_matrix_store(config)
+        self.inflight_downloads = get_inflight_downloads()
+        self.download_executor = get_download_executor(config)
+        self.object_info_ttl = int(config.get('object-info-ttl', DEFAULT_OBJECT_INFO_TTL))
+        self.stream_decode_bytes = int(config.get('stream-decode-min-mb',
+                                                  DEFAULT_STREAM_DECODE_MIN_MB)) * 1024 * 1024
+        self.token_hash = hashlib.sha256(context['token'].encode('utf8')).hexdigest()
+        self.type_cache = get_type_cache(config)
+        # objects retrieved while serving this request, shared by the requests of a batch
+        self.object_scope = context.get('object_scope')
+        if self.object_scope is None:
+            self.object_scope = ObjectScope()
 
     def select_row_ids(self, params):
         """
@@ -179,29 +496,34 @@ class Fetch:
         row_attribute_query = params.get('row_attribute_query', {})
         col_attribute_query = params.get('col_attribute_query', {})
 
-        _, matrix_data = self._retrieve_object(matrix_ref)
+        # the matrix values are only needed to drop empty rows for a col query
+        included = ['data'] if col_attribute_query else ['data/row_ids']
+        decoder = self._decode_matrix if col_attribute_query else None
+        dimensions = [dimension for dimension, query in [('row', row_attribute_query),
+                                                         ('col', col_attribute_query)] if query]
+        matrix_data = self._retrieve_with_attributes(matrix_ref, included, decoder, dimensions)
 
         if row_attribute_query:
-            row_attri_df = self._retrieve_attribute(matrix_data, 'row')
-            selcted_row_ids = self._select_id_from_attri(row_attri_df, row_attribute_query)
+            row_attri_index = self._retrieve_attribute(matrix_data, 'row')
+            selcted_row_ids = self._select_id_from_attri(row_attri_index, row_attribute_query)
+        elif col_attribute_query:
+            selcted_row_ids = matrix_data['data'].row_ids
         else:
             selcted_row_ids = matrix_data['data']['row_ids']
 
         if not col_attribute_query:
             return {'ids': selcted_row_ids}
         else:
-            col_attri_df = self._retrieve_attribute(matrix_data, 'col')
-            selcted_col_ids = self._select_id_from_attri(col_attri_df, col_attribute_query)
-
-            values = matrix_data['data']['values']
-            index = matrix_data['data']['row_ids']
-            columns = matrix_data['data']['col_ids']
-            df = pd.DataFrame(values, index=index, columns=columns)
+            col_attri_index = self._retrieve_attribute(matrix_data, 'col')
+            selcted_col_ids = self._select_id_from_attri(col_attri_index, col_attribute_query)
 
-            inter_df = df[selcted_col_ids].loc[selcted_row_ids].replace({np.nan: None})
+            matrix = matrix_data['data']
+            row_pos = matrix.row_lookup(selcted_row_ids)
+            col_pos = matrix.col_lookup(selcted_col_ids)
 
-            all_nan_row = inter_df.isnull().all(axis=1)
-            selcted_row_ids = all_nan_row[~all_nan_row].index.to_list()
+            nonempty_rows = matrix.nonempty_rows(row_pos, col_pos)
+            selcted_row_ids = [row_id for row_id, nonempty in zip(selcted_row_ids, nonempty_rows)
+                               if nonempty]
 
             return {'ids': selcted_row_ids}
 
@@ -221,29 +543,34 @@ class Fetch:
         row_attribute_query = params.get('row_attribute_query', {})
         col_attribute_query = params.get('col_attribute_query', {})
 
-        _, matrix_data = self._retrieve_object(matrix_ref)
+        # the matrix values are only needed to drop empty cols for a row query
+        included = ['data'] if row_attribute_query else ['data/col_ids']
+        decoder = self._decode_matrix if row_attribute_query else None
+        dimensions = [dimension for dimension, query in [('row', row_attribute_query),
+                                                         ('col', col_attribute_query)] if query]
+        matrix_data = self._retrieve_with_attributes(matrix_ref, included, decoder, dimensions)
 
         if col_attribute_query:
-            col_attri_df = self._retrieve_attribute(matrix_data, 'col')
-            selcted_col_ids = self._select_id_from_attri(col_attri_df, col_attribute_query)
+            col_attri_index = self._retrieve_attribute(matrix_data, 'col')
+            selcted_col_ids = self._select_id_from_attri(col_attri_index, col_attribute_query)
+        elif row_attribute_query:
+            selcted_col_ids = matrix_data['data'].col_ids
         else:
             selcted_col_ids = matrix_data['data']['col_ids']
 
         if not row_attribute_query:
             return {'ids': selcted_col_ids}
         else:
-            row_attri_df = self._retrieve_attribute(matrix_data, 'row')
-            selcted_row_ids = self._select_id_from_attri(row_attri_df, row_attribute_query)
+            row_attri_index = self._retrieve_attribute(matrix_data, 'row')
+            selcted_row_ids = self._select_id_from_attri(row_attri_index, row_attribute_query)
 
-            values = matrix_data['data']['values']
-            index = matrix_data['data']['row_ids']
-            columns = matrix_data['data']['col_ids']
-            df = pd.DataFrame(values, index=index, columns=columns)
-
-            inter_df = df[selcted_col_ids].loc[selcted_row_ids].replace({np.nan: None})
+            matrix = matrix_data['data']
+            row_pos = matrix.row_lookup(selcted_row_ids)
+            col_pos = matrix.col_lookup(selcted_col_ids)
 
-            all_nan_col = inter_df.isnull().all(axis=0)
-            selcted_col_ids = all_nan_col[~all_nan_col].index.to_list()
+            nonempty_cols = matrix.nonempty_cols(row_pos, col_pos)
+            selcted_col_ids = [col_id for col_id, nonempty in zip(selcted_col_ids, nonempty_cols)
+                               if nonempty]
 
             return {'ids': selcted_col_ids}
 
@@ -251,14 +578,22 @@ class Fetch:
         """
         arguments:
         matrix_ref: generics object reference
+
+        optional arguments:
+        format: encoding of the matrix values, one of MATRIX_FORMATS. 'json' by default
         """
         logging.info('--->\nrunning Fetch.fetch_all\n'
                      + 'params:\n{}'.format(json.dumps(params, indent=1)))
 
-        self.validate_params(params, ['matrix_ref'])
+        self.validate_params(params, ['matrix_ref'], ['format'])
         matrix_ref = params.get('matrix_ref')
+        matrix_format = self._validate_matrix_format(params)
+
+        # download the matrix and both attribute mappings concurrently; the methods below are
+        # served from the request's object scope
+        self._retrieve_with_attributes(matrix_ref, ['data'], self._decode_matrix, ['row', 'col'])
 
-        returnVal = self.fetch_data_by_ids({'matrix_ref': matrix_ref})
+        returnVal = self.fetch_data_by_ids({'matrix_ref': matrix_ref, 'format': matrix_format})
         row_attributes = self.fetch_attributes({'matrix_ref': matrix_ref})['attributes']
         col_attributes = self.fetch_attributes({'matrix_ref': matrix_ref,
                                                 'dimension': 'col'})['attributes']
@@ -274,50 +609,60 @@ class Fetch:
         matrix_ref: generics object reference
         row_ids: name of target row ids. If empty, return all row ids.
         col_ids: name of target col ids. If empty, return all col ids.
+
+        optional arguments:
+        format: encoding of the matrix values, one of MATRIX_FORMATS. 'json' by default.
+                Binary formats return the matrix as binary_data instead of data
         """
         logging.info('--->\nrunning Fetch.fetch_data_by_ids\n'
                      + 'params:\n{}'.format(json.dumps(params, indent=1)))
 
-        self.validate_params(params, ['matrix_ref'], ['row_ids', 'col_ids'])
+        self.validate_params(params, ['matrix_ref'], ['row_ids', 'col_ids', 'format'])
+        matrix_format = self._validate_matrix_format(params)
 
         matrix_ref = params.get('matrix_ref')
         row_ids = params.get('row_ids', [])
         col_ids = params.get('col_ids', [])
 
-        _, matrix_data = self._retrieve_object(matrix_ref)
-
-        values = matrix_data['data']['values']
-        index = matrix_data['data']['row_ids']
-        columns = matrix_data['data']['col_ids']
-        df = pd.DataFrame(values, index=index, columns=columns)
+        _, matrix_data = self._retrieve_object(matrix_ref, ['data'], self._decode_matrix)
+        matrix = matrix_data['data']
 
         if not row_ids:
-            inter_row_ids = df.index.to_list()
+            row_pos = list(range(len(matrix.row_ids)))
         else:
-            inter_row_ids = df.index.intersection(row_ids).to_list()
-        if not inter_row_ids:
+            row_pos = matrix.row_positions(row_ids)
+        if not row_pos:
             raise ValueError('Matrix index(row) ids have no intersection with given row_ids')
-        row_diff = len(row_ids) - len(inter_row_ids)
+        row_diff = len(row_ids) - len(row_pos)
         if row_diff:
             logging.info('Found {} given row_ids not included in the matrix row ids'.format(
                 row_diff))
 
         if not col_ids:
-            inter_col_ids = df.columns.to_list()
+            col_pos = list(range(len(matrix.col_ids)))
         else:
-            inter_col_ids = df.columns.intersection(col_ids).to_list()
-        if not inter_col_ids:
+            col_pos = matrix.col_positions(col_ids)
+        if not col_pos:
             raise ValueError('Matrix index(row) ids have no intersection with given row_ids')
-        col_diff = len(col_ids) - len(inter_col_ids)
+        col_diff = len(col_ids) - len(col_pos)
         if col_diff:
             logging.info('Found {} given row_ids not included in the matrix row ids'.format(
                 col_diff))
 
-        inter_df = df[inter_col_ids].loc[inter_row_ids].replace({np.nan: None})
+        values = matrix.submatrix(row_pos, col_pos)
+        selected_row_ids = [matrix.row_ids[pos] for pos in row_pos]
+        selected_col_ids = [matrix.col_ids[pos] for pos in col_pos]
 
-        returnVal = {'data': {'row_ids': inter_df.index.to_list(),
-                              'col_ids': inter_df.columns.to_list(),
-                              'values': inter_df.values.tolist()}}
+        if matrix_format == 'json':
+            returnVal = {'data': {'row_ids': selected_row_ids,
+                                  'col_ids': selected_col_ids,
+                                  'values': MatrixValues(values)}}
+        else:
+            returnVal = {'binary_data': {
+                'row_ids': selected_row_ids,
+                'col_ids': selected_col_ids,
+                'format': matrix_format,
+                'values': encode_binary_values(values, selected_col_ids, matrix_format)}}
 
         return returnVal
 
@@ -327,49 +672,54 @@ class Fetch:
         matrix_ref: generics object reference
         ids: name of row/col ids
         dimension: 'row' or 'col', 'row' by default
+
+        optional arguments:
+        format: shape of the attributes, one of ATTRIBUTE_FORMATS. 'dict' by default.
+                'columns' returns them as attribute_columns instead of attributes
         """
         logging.info('--->\nrunning Fetch.fetch_attributes\n'
                      + 'params:\n{}'.format(json.dumps(params, indent=1)))
 
-        self.validate_params(params, ['matrix_ref'], ['dimension', 'ids'])
+        self.validate_params(params, ['matrix_ref'], ['dimension', 'ids', 'format'])
+        attribute_format = params.get('format') or 'dict'
+        if attribute_format not in ATTRIBUTE_FORMATS:
+            raise ValueError('Unknown attribute format {}, expected one of {}'.format(
+                attribute_format, ATTRIBUTE_FORMATS))
 
         matrix_ref = params.get('matrix_ref')
         ids = params.get('ids', [])
         dimension = params.get('dimension', 'row')
 
-        _, matrix_data = self._retrieve_object(matrix_ref)
+        attribute_path = '{}_attributemapping_ref'.format(dimension)
+        _, matrix_data = self._retrieve_object(matrix_ref, [attribute_path])
 
-        attribute_ref = matrix_data.get('{}_attributemapping_ref'.format(dimension))
+        attribute_ref = matrix_data.get(attribute_path)
 
         if not attribute_ref:
             logging.info('Matrix object does not have {} attribute mapping object'.format(
                 dimension))
+            if attribute_format == 'columns':
+                return {'attribute_columns': {'ids': [], 'attributes': [], 'values': []}}
             return {'attributes': {}}
-        _, attri_data = self._retrieve_object(attribute_ref)
-
-        values = attri_data['instances'].values()
-        index = attri_data['instances'].keys()
-        columns = [x['attribute'] for x in attri_data['attributes']]
-        df = pd.DataFrame(values, index=index, columns=columns)
+        _, attri_index = self._retrieve_object(attribute_ref, ATTRIBUTE_PATHS,
+                                               AttributeIndex.from_data)
 
         if not ids:
-            inter_ids = df.index.to_list()
+            positions = list(range(len(attri_index.ids)))
         else:
-            inter_ids = df.index.intersection(ids).to_list()
-        if not inter_ids:
+            positions = attri_index.positions(ids)
+        if not positions:
             raise ValueError('Matrix {} ids have no intersection with given IDs'.format(dimension))
 
-        diff = len(ids) - len(inter_ids)
+        diff = len(ids) - len(positions)
         if diff:
             logging.info('Found {} given IDs not included in the matrix {} ids'.format(diff,
                                                                                        dimension))
 
-        attributes = dict()
-        selected_attri = df.loc[inter_ids]
-        for idx in selected_attri.index:
-            attributes[idx] = selected_attri.loc[idx].to_dict()
-
-        returnVal = {'attributes': attributes}
+        if attribute_format == 'columns':
+            returnVal = {'attribute_columns': attri_index.to_columns(positions)}
+        else:
+            returnVal = {'attributes': attri_index.to_dict(positions)}
 
         return returnVal
 
@@ -389,18 +739,82 @@ class Fetch:
         attribute_name = params.get('attribute_name')
         dimension = params.get('dimension', 'row')
 
-        _, matrix_data = self._retrieve_object(matrix_ref)
-        df = self._retrieve_attribute(matrix_data, dimension)
+        _, matrix_data = self._retrieve_object(
+            matrix_ref, ['{}_attributemapping_ref'.format(dimension)])
+        attri_index = self._retrieve_attribute(matrix_data, dimension)
 
-        if attribute_name not in df:
+        if attribute_name not in attri_index:
             raise ValueError('Cannot find {} from {} attribute mapping'.format(attribute_name,
                                                                                dimension))
 
-        attributes_count = df[attribute_name].value_counts().to_dict()
+        attributes_count = attri_index.value_counts(attribute_name)
         returnVal = {'attributes_count': attributes_count}
 
         return returnVal
 
+    def count_attribute_values(self, params):
+        """
+        arguments:
+        matrix_ref: generics object reference
+        attribute_names: names of attributes
+
+        optional arguments:
+        dimension: 'row' or 'col', 'row' by default
+        row_attribute_query, col_attribute_query: count only the ids that select_row_ids or
+                                                  select_col_ids returns for these queries
+        cross_tabulations: lists of attribute names to count the combinations of values of
+        """
+        logging.info('--->\nrunning Fetch.count_attribute_values\n'
+                     + 'params:\n{}'.format(json.dumps(params, indent=1)))
+
+        self.validate_params(params, ['matrix_ref', 'attribute_names'],
+                             ['dimension', 'row_attribute_query', 'col_attribute_query',
+                              'cross_tabulations'])
+
+        matrix_ref = params.get('matrix_ref')
+        attribute_names = params.get('attribute_names')
+        dimension = params.get('dimension', 'row')
+        row_attribute_query = params.get('row_attribute_query', {})
+        col_attribute_query = params.get('col_attribute_query', {})
+        cross_tabulations = params.get('cross_tabulations', [])
+
+        _, matrix_data = self._retrieve_object(
+            matrix_ref, ['{}_attributemapping_ref'.format(dimension)])
+        attri_index = self._retrieve_attribute(matrix_data, dimension)
+
+        for attribute_name in attribute_names + [name for names in cross_tabulations
+                                                 for name in names]:
+            if attribute_name not in attri_index:
+                raise ValueError('Cannot find {} from {} attribute mapping'.format(attribute_name,
+                                                                                   dimension))
+        for names in cross_tabulations:
+            if len(names) < 2:
+                raise ValueError('Cross tabulation {} needs at least 2 attributes'.format(names))
+
+        if row_attribute_query or col_attribute_query:
+            select_ids = self.select_row_ids if dimension == 'row' else self.select_col_ids
+            selected_ids = select_ids({'matrix_ref': matrix_ref,
+                                       'row_attribute_query': row_attribute_query,
+                                       'col_attribute_query': col_attribute_query})['ids']
+            positions = np.array(attri_index.positions(selected_ids), dtype=np.intp)
+            instance_count = len(positions)
+        else:
+            positions = None
+            instance_count = len(attri_index.ids)
+
+        attributes_counts = {name: attri_index.value_counts(name, positions)
+                             for name in attribute_names}
+        cross_counts = list()
+        for names in cross_tabulations:
+            values, counts = attri_index.cross_counts(names, positions)
+            cross_counts.append({'attributes': names, 'values': values, 'counts': counts})
+
+        returnVal = {'instance_count': instance_count,
+                     'attributes_counts': attributes_counts,
+                     'cross_tabulations': cross_counts}
+
+        return returnVal
+
     def fetch_data(self, params):
         """
         fetch_data: fetch generics data as pandas dataframe for a generics data object
@@ -3,7 +3,13 @@
 import logging
 import os
 
+from GenericsService.Compression import get_response_compressor
 from GenericsService.Fetch import Fetch
+from GenericsService.MatrixStore import get_matrix_store
+from GenericsService.ObjectCache import get_inflight_downloads, get_object_cache
+from GenericsService.SharedCache import get_shared_cache
+from GenericsService.TypeSpec import get_type_cache
+from installed_clients.baseclient import configure_connection_pool, connection_stats
 #END_HEADER
 
 
@@ -22,7 +28,7 @@ class GenericsService:
     # state. A method could easily clobber the state set by another while
     # the latter method is running.
     ######################################### noqa
-    VERSION = "1.0.0"
+    VERSION = "1.1.0"
     GIT_URL = "git@github.com:Tianhao-Gu/GenericsService.git"
     GIT_COMMIT_HASH = "97749921840a75dddeba9d2332aa743b5278bc1f"
 
@@ -37,6 +43,9 @@ class GenericsService:
         self.shared_folder = config['scratch']
         logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
                             level=logging.INFO)
+        configure_connection_pool(
+            pool_maxsize=config.get('http-pool-size'),
+            keep_alive=config.get('http-keep-alive', 'true').lower() == 'true')
         #END_CONSTRUCTOR
         pass
 
@@ -97,6 +106,49 @@ class GenericsService:
         # return the results
         return [returnVal]
 
+    def count_attribute_values(self, ctx, params):
+        """
+        count_attribute_values: return count of each attribute value for several attributes
+        :param params: instance of type "AttriValuesCountParams"
+           (attribute_names: names of attributes dimension: 'row' or 'col',
+           'row' by default row_attribute_query, col_attribute_query: count
+           only the ids select_row_ids (or select_col_ids for the 'col'
+           dimension) returns for these queries. All ids by default.
+           cross_tabulations: lists of at least 2 attribute names to count
+           combinations of values of) -> structure: parameter "matrix_ref" of
+           type "obj_ref" (An X/Y/Z style reference), parameter
+           "attribute_names" of list of String, parameter "dimension" of
+           String, parameter "row_attribute_query" of mapping from String to
+           list of String, parameter "col_attribute_query" of mapping from
+           String to list of String, parameter "cross_tabulations" of list of
+           list of String
+        :returns: instance of type "AttriValuesCountReturn" (instance_count:
+           number of ids counted attributes_counts: count of each value of
+           each attribute cross_tabulations: counts of the combinations of
+           values for each cross tabulation) -> structure: parameter
+           "instance_count" of Long, parameter "attributes_counts" of mapping
+           from String to mapping from String to Long, parameter
+           "cross_tabulations" of list of type "AttriCrossTabulation"
+           (attributes - the attribute names. values - the combinations of
+           values of the attributes held by ids, most common first. counts -
+           number of ids holding each combination of values.) -> structure:
+           parameter "attributes" of list of String, parameter "values" of
+           list of list of String, parameter "counts" of list of Long
+        """
+        # ctx is the context object
+        # return variables are: returnVal
+        #BEGIN count_attribute_values
+        fetch_utils = Fetch(self.config, ctx)
+        returnVal = fetch_utils.count_attribute_values(params)
+        #END count_attribute_values
+
+        # At some point might do deeper type checking...
+        if not isinstance(returnVal, dict):
+            raise ValueError('Method count_attribute_values return value ' +
+                             'returnVal is not type dict as required.')
+        # return the results
+        return [returnVal]
+
     def select_col_ids(self, ctx, params):
         """
         select_col_ids: list selected column IDs in the matrix
@@ -194,13 +246,24 @@ class GenericsService:
         return non-empty attributes for given row/col ids
         :param params: instance of type "FetchAttriParams" (ids: name of
            row/col ids. If empty, return all row ids. dimension: 'row' or
-           'col', 'row' by default) -> structure: parameter "matrix_ref" of
-           type "obj_ref" (An X/Y/Z style reference), parameter "ids" of list
-           of String, parameter "dimension" of String
+           'col', 'row' by default format: shape of the attributes, 'dict' by
+           default. 'dict' - attributes of each id in attributes 'columns' -
+           ids, attribute names and values of each attribute in
+           attribute_columns) -> structure: parameter "matrix_ref" of type
+           "obj_ref" (An X/Y/Z style reference), parameter "ids" of list of
+           String, parameter "dimension" of String, parameter "format" of
+           String
         :returns: instance of type "FetchAttriReturn" (attributes in dict
-           format e.g. {'PB-Low-5': {'IGSN': 'IEAWH0001'}}) -> structure:
-           parameter "attributes" of mapping from String to mapping from
-           String to String
+           format e.g. {'PB-Low-5': {'IGSN': 'IEAWH0001'}} attribute_columns:
+           the attributes for the columns format) -> structure: parameter
+           "attributes" of mapping from String to mapping from String to
+           String, parameter "attribute_columns" of type "AttributeColumns"
+           (Attributes of a list of ids held by columns. ids - the row/col
+           ids. attributes - the attribute names. values - the values of each
+           attribute for every id, indexed as: values[attribute][id]) ->
+           structure: parameter "ids" of list of String, parameter
+           "attributes" of list of String, parameter "values" of list of list
+           of String
         """
         # ctx is the context object
         # return variables are: returnVal
@@ -221,21 +284,36 @@ class GenericsService:
         return matrix data for specific row/col ids
         :param params: instance of type "FetchDataByIDParams" (row_ids: name
            of target row ids. If empty, return all row ids. col_ids: name of
-           target col ids. If empty, return all col ids.) -> structure:
-           parameter "matrix_ref" of type "obj_ref" (An X/Y/Z style
-           reference), parameter "row_ids" of list of String, parameter
-           "col_ids" of list of String
-        :returns: instance of type "FetchDataByIDReturn" -> structure:
-           parameter "data" of type "FloatMatrix2D" (A simple 2D matrix of
-           values with labels/ids for rows and columns.  The matrix is stored
-           as a list of lists, with the outer list containing rows, and the
-           inner lists containing values for each column of that row. Row/Col
-           ids should be unique. row_ids - unique ids for rows. col_ids -
-           unique ids for columns. values - two dimensional array indexed as:
-           values[row][col] @metadata ws length(row_ids) as n_rows @metadata
-           ws length(col_ids) as n_cols) -> structure: parameter "row_ids" of
-           list of String, parameter "col_ids" of list of String, parameter
-           "values" of list of list of Double
+           target col ids. If empty, return all col ids. format: encoding of
+           the matrix values, 'json' by default. 'json' - values as a list of
+           lists in data 'npy_base64' - values as a base64 encoded .npy array
+           in binary_data 'arrow_ipc_base64' - values as a base64 encoded
+           Arrow IPC stream in binary_data) -> structure: parameter
+           "matrix_ref" of type "obj_ref" (An X/Y/Z style reference),
+           parameter "row_ids" of list of String, parameter "col_ids" of list
+           of String, parameter "format" of String
+        :returns: instance of type "FetchDataByIDReturn" (data: the matrix
+           for the json format binary_data: the matrix for binary formats) ->
+           structure: parameter "data" of type "FloatMatrix2D" (A simple 2D
+           matrix of values with labels/ids for rows and columns.  The matrix
+           is stored as a list of lists, with the outer list containing rows,
+           and the inner lists containing values for each column of that row.
+           Row/Col ids should be unique. row_ids - unique ids for rows.
+           col_ids - unique ids for columns. values - two dimensional array
+           indexed as: values[row][col] @metadata ws length(row_ids) as
+           n_rows @metadata ws length(col_ids) as n_cols) -> structure:
+           parameter "row_ids" of list of String, parameter "col_ids" of list
+           of String, parameter "values" of list of list of Double, parameter
+           "binary_data" of type "BinaryMatrix2D" (A 2D matrix with its values
+           in a binary encoding, ids are sent as lists. row_ids - unique ids
+           for rows. col_ids - unique ids for columns. format - 'npy_base64'
+           or 'arrow_ipc_base64' values - base64 encoded values. npy_base64: a
+           float64 array of shape (n_rows, n_cols), missing values are NaN.
+           arrow_ipc_base64: a stream of one record batch with a float64
+           column named by each col id, missing values are null.) ->
+           structure: parameter "row_ids" of list of String, parameter
+           "col_ids" of list of String, parameter "format" of String,
+           parameter "values" of String
         """
         # ctx is the context object
         # return variables are: returnVal
@@ -254,22 +332,35 @@ class GenericsService:
     def fetch_all(self, ctx, params):
         """
         return all matrix data including attribute information
-        :param params: instance of type "FetchAllParams" -> structure:
-           parameter "matrix_ref" of type "obj_ref" (An X/Y/Z style reference)
-        :returns: instance of type "FetchAllReturn" -> structure: parameter
-           "row_attributes" of mapping from String to mapping from String to
-           String, parameter "col_attributes" of mapping from String to
-           mapping from String to String, parameter "data" of type
-           "FloatMatrix2D" (A simple 2D matrix of values with labels/ids for
-           rows and columns.  The matrix is stored as a list of lists, with
-           the outer list containing rows, and the inner lists containing
-           values for each column of that row. Row/Col ids should be unique.
-           row_ids - unique ids for rows. col_ids - unique ids for columns.
-           values - two dimensional array indexed as: values[row][col]
-           @metadata ws length(row_ids) as n_rows @metadata ws
-           length(col_ids) as n_cols) -> structure: parameter "row_ids" of
+        :param params: instance of type "FetchAllParams" (format: encoding
+           of the matrix values as for fetch_data_by_ids, 'json' by default.)
+           -> structure: parameter "matrix_ref" of type "obj_ref" (An X/Y/Z
+           style reference), parameter "format" of String
+        :returns: instance of type "FetchAllReturn" (data: the matrix for the
+           json format binary_data: the matrix for binary formats) ->
+           structure: parameter "row_attributes" of mapping from String to
+           mapping from String to String, parameter "col_attributes" of
+           mapping from String to mapping from String to String, parameter
+           "data" of type "FloatMatrix2D" (A simple 2D matrix of values with
+           labels/ids for rows and columns.  The matrix is stored as a list
+           of lists, with the outer list containing rows, and the inner lists
+           containing values for each column of that row. Row/Col ids should
+           be unique. row_ids - unique ids for rows. col_ids - unique ids for
+           columns. values - two dimensional array indexed as:
+           values[row][col] @metadata ws length(row_ids) as n_rows @metadata
+           ws length(col_ids) as n_cols) -> structure: parameter "row_ids" of
            list of String, parameter "col_ids" of list of String, parameter
-           "values" of list of list of Double
+           "values" of list of list of Double, parameter "binary_data" of type
+           "BinaryMatrix2D" (A 2D matrix with its values in a binary encoding,
+           ids are sent as lists. row_ids - unique ids for rows. col_ids -
+           unique ids for columns. format - 'npy_base64' or
+           'arrow_ipc_base64' values - base64 encoded values. npy_base64: a
+           float64 array of shape (n_rows, n_cols), missing values are NaN.
+           arrow_ipc_base64: a stream of one record batch with a float64
+           column named by each col id, missing values are null.) ->
+           structure: parameter "row_ids" of list of String, parameter
+           "col_ids" of list of String, parameter "format" of String,
+           parameter "values" of String
         """
         # ctx is the context object
         # return variables are: returnVal
@@ -290,6 +381,17 @@ class GenericsService:
                      'message': "",
                      'version': self.VERSION,
                      'git_url': self.GIT_URL,
-                     'git_commit_hash': self.GIT_COMMIT_HASH}
+                     'git_commit_hash': self.GIT_COMMIT_HASH,
+                     'object_cache': get_object_cache(self.config).stats(),
+                     'downloads': get_inflight_downloads().stats(),
+                     'type_cache': get_type_cache(self.config).stats(),
+                     'connections': connection_stats(),
+                     'compression': get_response_compressor(self.config).stats()}
+        shared_cache = get_shared_cache(self.config)
+        if shared_cache is not None:
+            returnVal['shared_cache'] = shared_cache.stats()
+        matrix_store = get_matrix_store(self.config)
+        if matrix_store is not None:
+            returnVal['matrix_store'] = matrix_store.stats()
         #END_STATUS
         return [returnVal]
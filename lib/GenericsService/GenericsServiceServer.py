@@ -346,6 +346,10 @@ class Application(object):
                              name='GenericsService.count_attribute_value',
                              types=[dict])
         self.method_authentication['GenericsService.count_attribute_value'] = 'required'  # noqa
+        self.rpc_service.add(impl_GenericsService.count_attribute_values,
+                             name='GenericsService.count_attribute_values',
+                             types=[dict])
+        self.method_authentication['GenericsService.count_attribute_values'] = 'required'  # noqa
         self.rpc_service.add(impl_GenericsService.select_col_ids,
                              name='GenericsService.select_col_ids',
                              types=[dict])
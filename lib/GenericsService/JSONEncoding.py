@@ -0,0 +1,155 @@
+import itertools
+import json
+import logging
+import re
+import uuid
+
+import numpy as np
+
+from GenericsService.Matrix import MatrixValues, nan_to_none
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class NumpyJSONEncoder(json.JSONEncoder):
+    '''
+    A stdlib JSON encoder for service results holding sets, numpy arrays and toJSONable objects.
+
+    hook is tried first for objects that cannot be encoded natively, it returns NotImplemented
+    for objects it does not handle.
+    '''
+
+    def __init__(self, *args, hook=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hook = hook
+
+    def default(self, obj):
+        if self.hook is not None:
+            value = self.hook(obj)
+            if value is not NotImplemented:
+                return value
+        if isinstance(obj, (set, frozenset)):
+            return list(obj)
+        if hasattr(obj, 'toJSONable'):
+            return obj.toJSONable()
+        if isinstance(obj, np.ndarray):
+            return nan_to_none(obj) if obj.dtype.kind == 'f' else obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        return json.JSONEncoder.default(self, obj)
+
+
+def json_dumps(obj, hook=None):
+    """
+    json_dumps: encode obj as UTF-8 JSON with the stdlib encoder
+    """
+    return json.dumps(obj, cls=NumpyJSONEncoder, hook=hook).encode('utf8')
+
+
+def _orjson_default(obj, hook=None):
+    if hook is not None:
+        value = hook(obj)
+        if value is not NotImplemented:
+            return value
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, '__array__'):
+        # orjson only serializes C contiguous arrays
+        return np.ascontiguousarray(obj)
+    if hasattr(obj, 'toJSONable'):
+        return obj.toJSONable()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def orjson_dumps(obj, hook=None):
+    """
+    orjson_dumps: encode obj as UTF-8 JSON with orjson, numpy arrays are written directly with
+                  NaN as null
+    """
+    default = _orjson_default if hook is None else lambda value: _orjson_default(value, hook)
+    try:
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        # e.g. integers beyond 64 bits, which the stdlib encoder handles
+        return json_dumps(obj, hook)
+
+
+JSON_ENCODERS = {'json': json_dumps}
+if orjson is not None:
+    JSON_ENCODERS['orjson'] = orjson_dumps
+
+DEFAULT_JSON_ENCODER = 'orjson' if orjson is not None else 'json'
+
+
+def get_json_encoder(name=None):
+    """
+    get_json_encoder: return the dumps function of the named JSON encoder, falling back to the
+                      stdlib encoder if it is not available
+    """
+    name = name or DEFAULT_JSON_ENCODER
+    if name not in JSON_ENCODERS:
+        logging.warning('JSON encoder {} is not available, using json'.format(name))
+        name = 'json'
+    return JSON_ENCODERS[name]
+
+
+def _iter_matrix_values(matrix_values, dumps, chunk_bytes):
+    values = matrix_values.values
+    n_rows, n_cols = values.shape
+    # about 20 bytes per encoded float
+    block_rows = max(1, chunk_bytes // (20 * max(n_cols, 1)))
+    if not n_rows:
+        yield b'[]'
+        return
+    for start in range(0, n_rows, block_rows):
+        block = dumps(MatrixValues(values[start:start + block_rows]))
+        # drop the brackets of each block to join the blocks into one list of rows
+        yield (b',' if start else b'[') + block[1:-1]
+    yield b']'
+
+
+def encode_chunks(obj, dumps, chunk_bytes):
+    """
+    encode_chunks: encode obj as UTF-8 JSON chunks
+
+    MatrixValues in obj are encoded in blocks of rows of about chunk_bytes. Encodings up to
+    chunk_bytes are done at once and returned as a list of chunks. Larger ones are returned as
+    an iterator whose first chunk_bytes are already encoded, the rest is encoded as the chunks
+    are consumed.
+    """
+    token = uuid.uuid4().hex
+    streamed = list()
+
+    def placeholder(value):
+        if isinstance(value, MatrixValues):
+            streamed.append(value)
+            return '{}:{}'.format(token, len(streamed) - 1)
+        return NotImplemented
+
+    envelope = dumps(obj, hook=placeholder)
+    if not streamed:
+        return [envelope]
+
+    marker = re.compile('"{}:(\\d+)"'.format(token).encode('ascii'))
+
+    def iter_chunks():
+        pos = 0
+        for match in marker.finditer(envelope):
+            yield envelope[pos:match.start()]
+            yield from _iter_matrix_values(streamed[int(match.group(1))], dumps, chunk_bytes)
+            pos = match.end()
+        yield envelope[pos:]
+
+    chunks = iter_chunks()
+    head = list()
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size > chunk_bytes:
+            return itertools.chain(head, chunks)
+    return head
@@ -0,0 +1,298 @@
+import array
+import base64
+import io
+import operator
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# encodings of the matrix values returned by fetch_data_by_ids and fetch_all
+MATRIX_FORMATS = ['json', 'npy_base64', 'arrow_ipc_base64']
+
+
+def nan_to_none(values):
+    """
+    nan_to_none: convert a float array to nested lists with NaN values as None
+    """
+    nan_mask = np.isnan(values)
+    if not nan_mask.any():
+        return values.tolist()
+    obj_values = values.astype(object)
+    obj_values[nan_mask] = None
+    return obj_values.tolist()
+
+
+def encode_binary_values(values, col_ids, matrix_format):
+    """
+    encode_binary_values: encode a float array as base64 text in a binary matrix format
+
+    npy_base64: a .npy float64 array of shape (n_rows, n_cols), missing values are NaN
+    arrow_ipc_base64: an Arrow IPC stream of one record batch with a float64 column named by
+                      each col id, missing values are null
+    """
+    if matrix_format == 'npy_base64':
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(values, dtype=np.float64), allow_pickle=False)
+        return base64.b64encode(buffer.getbuffer()).decode('ascii')
+
+    if matrix_format == 'arrow_ipc_base64':
+        if pa is None:
+            raise ValueError('pyarrow is required for the arrow_ipc_base64 format')
+        columns = [pa.array(values[:, pos], type=pa.float64(), from_pandas=True)
+                   for pos in range(values.shape[1])]
+        batch = pa.RecordBatch.from_arrays(columns, names=list(col_ids))
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, batch.schema) as writer:
+            writer.write_batch(batch)
+        return base64.b64encode(sink.getvalue()).decode('ascii')
+
+    raise ValueError('Unknown binary matrix format {}'.format(matrix_format))
+
+
+class MatrixValues(object):
+    '''
+    Matrix values returned by a service method, held as a float64 array until serialized.
+
+    Fast JSON encoders write the array directly with NaN as null, other encoders use
+    toJSONable. Compares equal to the nested lists it serializes to.
+    '''
+
+    __hash__ = None
+
+    def __init__(self, values):
+        self.values = values
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.values
+        return self.values.astype(dtype)
+
+    def toJSONable(self):
+        return nan_to_none(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.toJSONable())
+
+    def __getitem__(self, index):
+        return self.toJSONable()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, MatrixValues):
+            other = other.toJSONable()
+        return self.toJSONable() == other
+
+    def __repr__(self):
+        return 'MatrixValues({!r})'.format(self.toJSONable())
+
+
+class ValuesBuilder(object):
+    '''
+    Builds the float64 array of FloatMatrix2D values from the ijson events of its list of rows,
+    null values become NaN.
+
+    Used as a stream hook of the workspace client, so the values are read into an array
+    without ever being lists of python floats.
+    '''
+
+    def __init__(self):
+        self._values = array.array('d')
+        self._in_row = False
+        self._n_rows = 0
+        self._n_cols = None
+
+    def _end_row(self):
+        n_cols = len(self._values) // (self._n_rows + 1) if self._n_cols is None else self._n_cols
+        if len(self._values) != (self._n_rows + 1) * n_cols:
+            raise ValueError('Matrix values row {} does not have {} values'.format(
+                self._n_rows, n_cols))
+        self._n_rows += 1
+        self._n_cols = n_cols
+
+    def feed(self, events, start):
+        """
+        feed: add the values of a list of ijson (event, value) pairs from position start
+
+        returns the position after the end of the values, or None if they continue in the next
+        list of events
+        """
+        # rows are found and converted with list and numpy operations rather than value by value
+        names = list(map(operator.itemgetter(0), events[start:]))
+        pos = 0
+        while pos < len(names):
+            if self._in_row:
+                try:
+                    end = names.index('end_array', pos)
+                except ValueError:
+                    end = len(names)
+                row_names = names[pos:end]
+                if len(row_names) != row_names.count('number') + row_names.count('null'):
+                    raise ValueError('Matrix values are not a list of rows of numbers')
+                row = list(map(operator.itemgetter(1), events[start + pos:start + end]))
+                self._values.frombytes(np.array(row, dtype=np.float64).tobytes())
+                if end == len(names):
+                    break
+                self._end_row()
+                self._in_row = False
+                pos = end + 1
+            elif names[pos] == 'start_array':
+                self._in_row = True
+                pos += 1
+            elif names[pos] == 'end_array':
+                return start + pos + 1
+            else:
+                raise ValueError('Matrix values are not a list of rows of numbers')
+        return None
+
+    def result(self):
+        """
+        result: the values as an array of shape (n_rows, n_cols)
+        """
+        return np.frombuffer(self._values, dtype=np.float64).reshape(self._n_rows,
+                                                                    self._n_cols or 0)
+
+
+class Matrix(object):
+    '''
+    A FloatMatrix2D held as a float64 array with id to position lookups for rows and columns.
+    '''
+
+    def __init__(self, row_ids, col_ids, values):
+        self.row_ids = row_ids
+        self.col_ids = col_ids
+        self.values = values
+        self.row_index = {row_id: pos for pos, row_id in enumerate(row_ids)}
+        self.col_index = {col_id: pos for pos, col_id in enumerate(col_ids)}
+        self._row_counts = None
+        self._col_counts = None
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        from_data: build a Matrix from FloatMatrix2D data, None values become NaN
+
+        the values are lists of rows, converted to float64 in one pass, or an array built by a
+        ValuesBuilder
+        """
+        row_ids = data['row_ids']
+        col_ids = data['col_ids']
+        values = data['values']
+        if isinstance(values, np.ndarray):
+            valid_shape = values.shape == (len(row_ids), len(col_ids))
+        else:
+            valid_shape = (len(values) == len(row_ids) and
+                           all(len(row) == len(col_ids) for row in values))
+        if not valid_shape:
+            raise ValueError('Matrix values are not {} rows of {} values'.format(len(row_ids),
+                                                                                len(col_ids)))
+        values = np.asarray(values, dtype=np.float64).reshape(len(row_ids), len(col_ids))
+        return cls(row_ids, col_ids, values)
+
+    def to_dataframe(self):
+        """
+        to_dataframe: the values as a pandas DataFrame indexed by the row and col ids, sharing
+                      the values array
+        """
+        return pd.DataFrame(self.values, index=self.row_ids, columns=self.col_ids, copy=False)
+
+    @property
+    def nbytes(self):
+        # ids are estimated at 64 bytes each including their index entry. Values mapped from a
+        # file are in shared pages but count in full: a cached matrix keeps its file mapped, and
+        # its space in the matrix store, until the cache drops it
+        return self.values.nbytes + 64 * (len(self.row_ids) + len(self.col_ids))
+
+    @staticmethod
+    def _positions(index, ids):
+        return sorted({index[id_] for id_ in ids if id_ in index})
+
+    def row_positions(self, row_ids):
+        """
+        row_positions: positions of the given row ids found in the matrix, in matrix order
+        """
+        return self._positions(self.row_index, row_ids)
+
+    def col_positions(self, col_ids):
+        """
+        col_positions: positions of the given col ids found in the matrix, in matrix order
+        """
+        return self._positions(self.col_index, col_ids)
+
+    @staticmethod
+    def _lookup(index, ids, dimension):
+        missing = [id_ for id_ in ids if id_ not in index]
+        if missing:
+            raise ValueError('Matrix {} ids do not contain {}'.format(dimension, missing))
+        return [index[id_] for id_ in ids]
+
+    def row_lookup(self, row_ids):
+        """
+        row_lookup: positions of the given row ids in the given order, all ids must exist
+        """
+        return self._lookup(self.row_index, row_ids, 'row')
+
+    def col_lookup(self, col_ids):
+        """
+        col_lookup: positions of the given col ids in the given order, all ids must exist
+        """
+        return self._lookup(self.col_index, col_ids, 'col')
+
+    @property
+    def row_counts(self):
+        """
+        row_counts: number of non-NaN values in each row
+        """
+        if self._row_counts is None:
+            self._row_counts = np.count_nonzero(~np.isnan(self.values), axis=1)
+        return self._row_counts
+
+    @property
+    def col_counts(self):
+        """
+        col_counts: number of non-NaN values in each col
+        """
+        if self._col_counts is None:
+            self._col_counts = np.count_nonzero(~np.isnan(self.values), axis=0)
+        return self._col_counts
+
+    @staticmethod
+    def _as_slice(positions):
+        if len(positions) and (np.diff(positions) == 1).all():
+            return slice(positions[0], positions[-1] + 1)
+        return None
+
+    def submatrix(self, row_pos, col_pos):
+        """
+        submatrix: the values at the given row and col positions
+
+        a run of consecutive rows and cols is returned as a view of the values, other selections
+        are copied
+        """
+        row_slice = self._as_slice(row_pos)
+        col_slice = self._as_slice(col_pos)
+        if row_slice is not None and col_slice is not None:
+            return self.values[row_slice, col_slice]
+        return self.values[np.ix_(row_pos, col_pos)]
+
+    def nonempty_rows(self, row_pos, col_pos):
+        """
+        nonempty_rows: mask of the given rows having a value in any of the given cols
+        """
+        if len(col_pos) == self.values.shape[1]:
+            return self.row_counts[row_pos] > 0
+        return ~np.isnan(self.submatrix(row_pos, col_pos)).all(axis=1)
+
+    def nonempty_cols(self, row_pos, col_pos):
+        """
+        nonempty_cols: mask of the given cols having a value in any of the given rows
+        """
+        if len(row_pos) == self.values.shape[0]:
+            return self.col_counts[col_pos] > 0
+        return ~np.isnan(self.submatrix(row_pos, col_pos)).all(axis=0)
@@ -0,0 +1,277 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import weakref
+
+import numpy as np
+
+from GenericsService.Attributes import AttributeIndex
+from GenericsService.Matrix import Matrix
+
+SHM_DIR = '/dev/shm'
+STORE_DIR_NAME = 'generics_matrix_store'
+CACHE_DIR_NAME = 'generics_matrix_cache'
+
+
+class MatrixStore(object):
+    '''
+    Decoded matrix objects and attribute tables kept in files shared by all worker processes.
+
+    The values of the Matrix in the 'data' field of a matrix object are saved as a .npy file
+    that every worker maps read-only, so all workers use the same physical pages. The rest of
+    the object, including the row and col ids, is saved as JSON next to it. Attribute tables
+    are saved as JSON with the codes and unique values of each attribute.
+
+    Files are evicted least recently used first when the store grows beyond max_bytes. Files
+    mapped by matrices alive in this process are reference counted and not evicted by it.
+
+    A store in memory can be backed by a persistent store on disk: entries missing from the
+    store are copied from the backing store and new entries are copied to it.
+    '''
+
+    def __init__(self, directory, max_bytes, backing_store=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._max_bytes = max_bytes
+        self._backing_store = backing_store
+        self._refs = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _name(self, key):
+        return hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+
+    def _paths(self, name):
+        path = os.path.join(self.directory, name)
+        return path + '.json', path + '.npy'
+
+    def _release(self, name):
+        with self._lock:
+            self._refs[name] -= 1
+            if not self._refs[name]:
+                del self._refs[name]
+
+    def _load(self, name):
+        meta_path, values_path = self._paths(name)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['kind'] == 'matrix':
+                obj_data = meta['object']
+                values = np.load(values_path, mmap_mode='r', allow_pickle=False)
+            elif meta['kind'] == 'attribute_columns':
+                obj_data = self._decode_attributes(meta)
+            else:
+                return None
+            # the modification time of the JSON file orders the entries for eviction
+            os.utime(meta_path)
+        except (OSError, KeyError, ValueError):
+            return None
+
+        if meta['kind'] == 'matrix':
+            with self._lock:
+                self._refs[name] = self._refs.get(name, 0) + 1
+            weakref.finalize(values, self._release, name)
+            matrix_data = obj_data['data']
+            obj_data['data'] = Matrix(matrix_data['row_ids'], matrix_data['col_ids'], values)
+        return obj_data
+
+    @staticmethod
+    def _encode_attributes(attri_index):
+        columns = list()
+        for name in attri_index.attribute_names:
+            codes, uniques = attri_index.column(name)
+            columns.append({'codes': codes.tolist(), 'uniques': uniques})
+        return {'kind': 'attribute_columns',
+                'attributes': attri_index.attribute_names,
+                'ids': attri_index.ids,
+                'columns': columns}
+
+    @staticmethod
+    def _decode_attributes(meta):
+        columns = [(np.array(column['codes'], dtype=np.int32), column['uniques'])
+                   for column in meta['columns']]
+        return AttributeIndex(meta['ids'], meta['attributes'], columns)
+
+    def _copy_from(self, store, name):
+        """
+        _copy_from: copy an entry of another store into this store, returns whether it was copied
+        """
+        source_meta_path = store._paths(name)[0]
+        if not os.path.exists(source_meta_path):
+            return False
+        tmp_suffix = '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+        try:
+            os.utime(source_meta_path)
+            # the JSON file is copied last, an entry without it is incomplete
+            for source, target in reversed(list(zip(store._paths(name), self._paths(name)))):
+                if os.path.exists(source):
+                    shutil.copyfile(source, target + tmp_suffix)
+                    os.replace(target + tmp_suffix, target)
+        except OSError:
+            logging.warning('Cannot copy {} from {}'.format(name, store.directory))
+            for path in self._paths(name):
+                if os.path.exists(path + tmp_suffix):
+                    os.remove(path + tmp_suffix)
+            return False
+        self._evict()
+        return True
+
+    def get(self, key):
+        """
+        get: the stored object with its matrix values mapped from the store, or None
+        """
+        name = self._name(key)
+        obj_data = self._load(name)
+        if (obj_data is None and self._backing_store is not None
+                and self._copy_from(self._backing_store, name)):
+            obj_data = self._load(name)
+        with self._lock:
+            if obj_data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return obj_data
+
+    def add(self, key, obj_data):
+        """
+        add: store a matrix object holding a Matrix in its 'data' field or an AttributeIndex
+
+        returns the object to use in place of obj_data, with matrix values mapped from the store,
+        or None if it was not stored
+        """
+        if isinstance(obj_data, AttributeIndex):
+            meta = self._encode_attributes(obj_data)
+            values = None
+        else:
+            matrix = obj_data.get('data')
+            if not isinstance(matrix, Matrix) or matrix.values.nbytes > self._max_bytes:
+                return None
+            meta = {'kind': 'matrix', 'object': dict(obj_data)}
+            meta['object']['data'] = {'row_ids': matrix.row_ids, 'col_ids': matrix.col_ids}
+            values = matrix.values
+
+        name = self._name(key)
+        meta_path, values_path = self._paths(name)
+        tmp_suffix = '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+        try:
+            if values is not None:
+                with open(values_path + tmp_suffix, 'wb') as f:
+                    np.save(f, np.ascontiguousarray(values), allow_pickle=False)
+                os.replace(values_path + tmp_suffix, values_path)
+            # the JSON file is written last, an entry without it is incomplete
+            with open(meta_path + tmp_suffix, 'w') as f:
+                json.dump(meta, f)
+            os.replace(meta_path + tmp_suffix, meta_path)
+        except (OSError, TypeError, ValueError):
+            logging.warning('Cannot store {} in {}'.format(key, self.directory))
+            for path in (values_path + tmp_suffix, meta_path + tmp_suffix):
+                if os.path.exists(path):
+                    os.remove(path)
+            return None
+
+        with self._lock:
+            self.stores += 1
+        self._evict()
+        if self._backing_store is not None:
+            self._backing_store._copy_from(self, name)
+        return obj_data if values is None else self._load(name)
+
+    def _entries(self):
+        entries = list()
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.json'):
+                continue
+            name = file_name[:-len('.json')]
+            meta_path, values_path = self._paths(name)
+            try:
+                meta_stat = os.stat(meta_path)
+                size = meta_stat.st_size
+                if os.path.exists(values_path):
+                    size += os.stat(values_path).st_size
+            except OSError:
+                continue
+            entries.append((meta_stat.st_mtime, name, size))
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            with self._lock:
+                if name in self._refs:
+                    continue
+                self.evictions += 1
+            for path in self._paths(name):
+                try:
+                    # workers still mapping the values keep their pages until they unmap them
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            stats = {'directory': self.directory,
+                     'max_bytes': self._max_bytes,
+                     'mapped': len(self._refs),
+                     'hits': self.hits,
+                     'misses': self.misses,
+                     'stores': self.stores,
+                     'evictions': self.evictions}
+        if self._backing_store is not None:
+            stats['backing_store'] = self._backing_store.stats()
+        return stats
+
+
+_matrix_store = None
+_matrix_store_lock = threading.Lock()
+
+
+def get_matrix_store(config):
+    """
+    get_matrix_store: return the process-wide matrix store, or None if it is disabled
+
+    matrix-store-size-mb of matrices are kept in shared memory if /dev/shm has room for them,
+    backed by matrix-cache-size-mb of matrices kept in scratch across restarts. Entries are keyed
+    on workspace refs, so each workspace-url gets its own directories
+    """
+    global _matrix_store
+    with _matrix_store_lock:
+        if _matrix_store is None:
+            _matrix_store = False
+            store_bytes = int(config.get('matrix-store-size-mb', 0)) * 1024 * 1024
+            cache_bytes = int(config.get('matrix-cache-size-mb', 0)) * 1024 * 1024
+            workspace_dir_name = hashlib.sha1(
+                config.get('workspace-url', '').encode('utf8')).hexdigest()[:16]
+
+            directory = config.get('matrix-store-dir')
+            if store_bytes and not directory and os.path.isdir(SHM_DIR):
+                shm_stat = os.statvfs(SHM_DIR)
+                if shm_stat.f_bavail * shm_stat.f_frsize >= store_bytes:
+                    directory = os.path.join(SHM_DIR, STORE_DIR_NAME)
+            if store_bytes and not directory and not cache_bytes:
+                directory = os.path.join(config['scratch'], STORE_DIR_NAME)
+
+            try:
+                cache = None
+                if cache_bytes:
+                    cache = MatrixStore(os.path.join(config['scratch'], CACHE_DIR_NAME,
+                                                     workspace_dir_name), cache_bytes)
+                if store_bytes and directory:
+                    _matrix_store = MatrixStore(os.path.join(directory, workspace_dir_name),
+                                                store_bytes, cache)
+                elif cache is not None:
+                    # files in scratch are shared through the page cache as well
+                    _matrix_store = cache
+            except OSError:
+                logging.warning('Cannot create matrix store')
+        return _matrix_store or None
@@ -0,0 +1,225 @@
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE_MB = 256
+
+
+class ObjectCache(object):
+    '''
+    A byte-bounded LRU cache for workspace objects.
+
+    Entries are keyed on fully resolved wsid/objid/ver references, so a cached value never goes
+    stale. Cached values are shared between requests and must be treated as read-only.
+
+    Keys are (reference, paths, decoder) tuples, the paths each object is cached with are indexed
+    so that a request can use an entry holding more of the object than it asked for.
+    '''
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._paths = dict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, *keys):
+        """
+        get: return the value of the first cached key, or None
+        """
+        with self._lock:
+            for key in keys:
+                entry = self._cache.get(key)
+                if entry is not None:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+            self.misses += 1
+            return None
+
+    def paths(self, upa, decoder):
+        """
+        paths: the paths of the cached entries of an object for a decoder
+        """
+        with self._lock:
+            return list(self._paths.get((upa, decoder), ()))
+
+    def _remove_paths(self, key):
+        upa, paths, decoder = key
+        cached_paths = self._paths[(upa, decoder)]
+        cached_paths.discard(paths)
+        if not cached_paths:
+            del self._paths[(upa, decoder)]
+
+    def add(self, key, value, size):
+        if size > self._max_bytes:
+            logging.info('Object {} ({} bytes) exceeds cache size, not caching'.format(key, size))
+            return
+        upa, paths, decoder = key
+        with self._lock:
+            old_entry = self._cache.pop(key, None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+            self._cache[key] = (value, size)
+            self._paths.setdefault((upa, decoder), set()).add(paths)
+            self._size += size
+            while self._size > self._max_bytes:
+                evicted_key, (_, evicted_size) = self._cache.popitem(last=False)
+                self._remove_paths(evicted_key)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._cache),
+                    'bytes': self._size,
+                    'max_bytes': self._max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class ObjectScope(object):
+    '''
+    The objects retrieved while serving a request, or a batch of requests, keyed by the ref they
+    were asked for, the object paths they were retrieved with and the decoder applied to them.
+
+    The lock is held to look up and add objects only. Requests of a batch needing the same
+    object while it is downloaded share the download through InflightDownloads.
+    '''
+
+    def __init__(self):
+        self._objects = dict()
+        self.lock = threading.RLock()
+
+    def items(self):
+        with self.lock:
+            return list(self._objects.items())
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self._objects[key] = value
+
+
+class _Download(object):
+    ''' A download in progress, shared by concurrent requests. '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class InflightDownloads(object):
+    '''
+    The object downloads in progress in this process, keyed like the object cache.
+
+    A request needing an object that another thread is downloading waits for that download and
+    shares its result instead of downloading the object again.
+    '''
+
+    def __init__(self):
+        self._downloads = dict()
+        self._lock = threading.Lock()
+        self.started = 0
+        self.saved = 0
+
+    def join(self, keys):
+        """
+        join: the downloads of the given keys and the keys the caller has to download
+
+        the caller must finish the downloads of the returned keys
+        """
+        downloads = dict()
+        started = list()
+        with self._lock:
+            for key in keys:
+                download = self._downloads.get(key)
+                if download is None:
+                    download = self._downloads[key] = _Download()
+                    started.append(key)
+                    self.started += 1
+                else:
+                    self.saved += 1
+                downloads[key] = download
+        return downloads, started
+
+    def finish(self, downloads, keys, error=None):
+        """
+        finish: end the downloads of the given keys, with their result or the error they
+                failed with
+        """
+        with self._lock:
+            for key in keys:
+                del self._downloads[key]
+        for key in keys:
+            downloads[key].error = error
+            downloads[key].done.set()
+
+    @staticmethod
+    def wait(download):
+        """
+        wait: the result of a download once it is finished
+        """
+        download.done.wait()
+        if download.error is not None:
+            raise download.error
+        return download.result
+
+    def stats(self):
+        with self._lock:
+            return {'in_progress': len(self._downloads),
+                    'started': self.started,
+                    'saved': self.saved}
+
+
+def estimate_size(obj, sample_size=10):
+    """
+    estimate_size: estimate the serialized size of a JSON-like object
+
+    only the first sample_size items of each list and mapping are measured, objects that know
+    their size in memory, like numpy arrays, report their nbytes
+    """
+    if hasattr(obj, 'nbytes'):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        items = list(itertools.islice(obj.items(), sample_size))
+        sampled = sum(len(key) + 4 + estimate_size(value, sample_size) for key, value in items)
+        return 2 + (sampled * len(obj) // len(items) if items else 0)
+    if isinstance(obj, (list, tuple)):
+        items = obj[:sample_size]
+        sampled = sum(1 + estimate_size(value, sample_size) for value in items)
+        return 2 + (sampled * len(obj) // len(items) if items else 0)
+    if isinstance(obj, str):
+        return len(obj) + 2
+    return 8
+
+
+_object_cache = None
+_object_cache_lock = threading.Lock()
+
+
+def get_object_cache(config):
+    """
+    get_object_cache: return the process-wide object cache, creating it on first use
+    """
+    global _object_cache
+    with _object_cache_lock:
+        if _object_cache is None:
+            size_mb = int(config.get('object-cache-size-mb', DEFAULT_CACHE_SIZE_MB))
+            _object_cache = ObjectCache(size_mb * 1024 * 1024)
+        return _object_cache
+
+
+_inflight_downloads = InflightDownloads()
+
+
+def get_inflight_downloads():
+    """
+    get_inflight_downloads: return the process-wide downloads in progress
+    """
+    return _inflight_downloads
@@ -0,0 +1,196 @@
+import abc
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+UWSGI_CACHE_NAME = 'generics_service'
+SHARED_CACHE_FILE = 'shared_cache_{}x{}.bin'
+DEFAULT_SHARED_CACHE_MB = 64
+# room for object infos with a few kb of user metadata, larger values are not shared
+DEFAULT_SLOT_SIZE = 4096
+# the blocksize of the uwsgi cache, see the startup script in the Makefile
+UWSGI_BLOCK_SIZE = 4096
+DEFAULT_PROBES = 8
+
+# key digest, expiry time, value length and crc32 of the value
+_SLOT_HEADER = struct.Struct('<16sdII')
+
+
+class SharedCache(abc.ABC):
+    '''
+    A cache of small JSON values shared by the worker processes of a server.
+
+    Entries expire after the ttl they were added with. Lookups of values that cannot be read,
+    e.g. an entry overwritten by another worker, are misses. Values larger than max_value_size
+    are not cached and counted as oversize.
+    '''
+
+    backend = None
+
+    def __init__(self, max_value_size):
+        self.max_value_size = max_value_size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.oversize = 0
+
+    @abc.abstractmethod
+    def _get_bytes(self, key):
+        pass
+
+    @abc.abstractmethod
+    def _set_bytes(self, key, value, ttl):
+        pass
+
+    def get(self, key):
+        value = self._get_bytes(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value, ttl):
+        value = json.dumps(value).encode('utf8')
+        if len(value) > self.max_value_size:
+            with self._lock:
+                self.oversize += 1
+            return
+        self._set_bytes(key, value, ttl)
+        with self._lock:
+            self.sets += 1
+
+    def stats(self):
+        with self._lock:
+            return {'backend': self.backend,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'sets': self.sets,
+                    'oversize': self.oversize}
+
+
+class UwsgiSharedCache(SharedCache):
+    '''
+    A SharedCache in a cache of the uwsgi server, e.g. one configured with
+    --cache2 name=generics_service,items=20000,blocksize=4096
+    '''
+
+    backend = 'uwsgi'
+
+    def __init__(self, cache_name=UWSGI_CACHE_NAME, block_size=UWSGI_BLOCK_SIZE):
+        super().__init__(block_size)
+        self._cache_name = cache_name
+
+    def _get_bytes(self, key):
+        return uwsgi.cache_get(key, self._cache_name)
+
+    def _set_bytes(self, key, value, ttl):
+        uwsgi.cache_update(key, value, int(ttl), self._cache_name)
+
+
+class MmapSharedCache(SharedCache):
+    '''
+    A SharedCache in a memory mapped file used as a hash table of fixed size slots.
+
+    A key is stored in one of the probes slots following its hash position, replacing the
+    entry expiring first if all of them are taken. Writes are not locked across processes,
+    a torn entry fails its checksum and reads as a miss.
+    '''
+
+    backend = 'mmap'
+
+    def __init__(self, path, size_bytes, slot_size=DEFAULT_SLOT_SIZE, probes=DEFAULT_PROBES):
+        super().__init__(slot_size - _SLOT_HEADER.size)
+        self._slot_size = slot_size
+        self._n_slots = max(1, size_bytes // slot_size)
+        self._probes = min(probes, self._n_slots)
+        size = self._n_slots * slot_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def _slots(self, digest):
+        start = int.from_bytes(digest[:8], 'little') % self._n_slots
+        return [(start + i) % self._n_slots * self._slot_size for i in range(self._probes)]
+
+    def _get_bytes(self, key):
+        digest = hashlib.blake2b(key.encode('utf8'), digest_size=16).digest()
+        now = time.time()
+        for offset in self._slots(digest):
+            slot = self._map[offset:offset + self._slot_size]
+            slot_digest, expires, length, crc = _SLOT_HEADER.unpack_from(slot)
+            if slot_digest != digest:
+                continue
+            value = slot[_SLOT_HEADER.size:_SLOT_HEADER.size + length]
+            if expires < now or len(value) != length or zlib.crc32(value) != crc:
+                return None
+            return value
+        return None
+
+    def _set_bytes(self, key, value, ttl):
+        digest = hashlib.blake2b(key.encode('utf8'), digest_size=16).digest()
+        target, target_expires = None, None
+        for offset in self._slots(digest):
+            slot_digest, expires, _, _ = _SLOT_HEADER.unpack_from(self._map, offset)
+            if slot_digest == digest:
+                target = offset
+                break
+            if target is None or expires < target_expires:
+                target, target_expires = offset, expires
+        self._map[target:target + _SLOT_HEADER.size + len(value)] = _SLOT_HEADER.pack(
+            digest, time.time() + ttl, len(value), zlib.crc32(value)) + value
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache(config):
+    """
+    get_shared_cache: return the process-wide shared cache, or None if it is disabled
+
+    the shared-cache option selects the backend: uwsgi, mmap, none, or auto for the uwsgi
+    cache when running in uwsgi with the cache configured and mmap otherwise
+    """
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            config = config or dict()
+            backend = config.get('shared-cache', 'none').lower()
+            if backend in ('auto', 'uwsgi') and uwsgi is not None:
+                try:
+                    uwsgi.cache_exists('probe', UWSGI_CACHE_NAME)
+                    _shared_cache = UwsgiSharedCache()
+                except Exception:
+                    logging.warning('uwsgi cache {} is not configured'.format(UWSGI_CACHE_NAME))
+            if _shared_cache is None and backend in ('auto', 'mmap') and config.get('scratch'):
+                size_mb = int(config.get('shared-cache-size-mb', DEFAULT_SHARED_CACHE_MB))
+                slot_size = DEFAULT_SLOT_SIZE
+                n_slots = size_mb * 1024 * 1024 // slot_size
+                path = os.path.join(config['scratch'],
+                                    SHARED_CACHE_FILE.format(n_slots, slot_size))
+                try:
+                    _shared_cache = MmapSharedCache(path, n_slots * slot_size, slot_size)
+                except (OSError, ValueError):
+                    logging.warning('Cannot create shared cache {}'.format(path))
+            if _shared_cache is None:
+                # disabled, not looked up again
+                _shared_cache = False
+        return _shared_cache or None
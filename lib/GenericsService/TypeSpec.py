@@ -0,0 +1,264 @@
+import json
+import logging
+import os
+import re
+import threading
+
+TYPE_CACHE_FILE = 'generics_type_cache.json'
+
+# a type string with both major and minor version, e.g. KBaseMatrices.ExpressionMatrix-1.2
+VERSIONED_TYPE = re.compile(r'^\w+\.\w+-\d+\.\d+$')
+
+KIDL_TOKEN = re.compile(r'''
+    (?P<skip>\s+|/\*.*?\*/|//[^\n]*|\#include[^\n]*)
+  | (?P<name>\w[\w.]*)
+  | (?P<punct>[^\s\w])
+''', re.S | re.X)
+
+KIDL_BUILTINS = {'int', 'float', 'string', 'bool', 'UnspecifiedObject'}
+
+
+def tokenize(spec):
+    """
+    tokenize: split KIDL spec text into names and punctuation, dropping comments and
+              #include lines
+    """
+    tokens = list()
+    pos = 0
+    while pos < len(spec):
+        match = KIDL_TOKEN.match(spec, pos)
+        if not match:
+            raise ValueError('Unexpected character in spec at {}: {}'.format(pos,
+                                                                             spec[pos:pos + 20]))
+        if match.lastgroup != 'skip':
+            tokens.append(match.group())
+        pos = match.end()
+    return tokens
+
+
+class SpecModel(object):
+    '''
+    An index of the typedefs in a KIDL spec.
+
+    Type expressions are stored as tuples:
+    ('name', 'Module.Type'), ('list', expr), ('mapping', key_expr, value_expr),
+    ('tuple', [expr, ...]) and ('structure', [(field_name, expr), ...])
+    '''
+
+    def __init__(self, spec):
+        self.typedefs = dict()
+        self._tokens = tokenize(spec)
+        self._pos = 0
+        self._parse_statements()
+        del self._tokens
+
+    def _peek(self):
+        return self._tokens[self._pos] if self._pos < len(self._tokens) else None
+
+    def _next(self, expected=None):
+        token = self._peek()
+        if token is None:
+            raise ValueError('Unexpected end of spec')
+        if expected is not None and token != expected:
+            raise ValueError('Expected "{}" in spec but found "{}"'.format(expected, token))
+        self._pos += 1
+        return token
+
+    def _parse_statements(self):
+        while self._peek() is not None:
+            token = self._next()
+            if token == 'typedef':
+                type_expr = self._parse_type()
+                self.typedefs[self._next()] = type_expr
+                self._next(';')
+            elif token == 'module':
+                # module name and any annotations up to the module body
+                while self._next() != '{':
+                    pass
+            elif token in ('}', ';'):
+                continue
+            else:
+                # funcdefs and other statements that do not define types
+                self._skip_statement()
+
+    def _skip_statement(self):
+        depth = 0
+        while True:
+            token = self._next()
+            if token in ('(', '{', '<'):
+                depth += 1
+            elif token in (')', '}', '>'):
+                depth -= 1
+            elif token == ';' and depth <= 0:
+                return
+
+    def _parse_type(self):
+        token = self._next()
+        if token == 'structure':
+            self._next('{')
+            fields = list()
+            while self._peek() != '}':
+                field_type = self._parse_type()
+                fields.append((self._next(), field_type))
+                self._next(';')
+            self._next('}')
+            return ('structure', fields)
+        if token == 'list':
+            self._next('<')
+            item_type = self._parse_type()
+            self._next('>')
+            return ('list', item_type)
+        if token in ('mapping', 'tuple'):
+            self._next('<')
+            item_types = list()
+            while True:
+                item_types.append(self._parse_type())
+                if self._peek() not in (',', '>'):
+                    self._next()  # optional item name
+                if self._next() == '>':
+                    break
+            if token == 'mapping':
+                return ('mapping', item_types[0], item_types[1])
+            return ('tuple', item_types)
+        if not re.match(r'^[A-Za-z_]', token):
+            raise ValueError('Expected a type in spec but found "{}"'.format(token))
+        return ('name', token)
+
+    def _referenced_names(self, type_expr, seen=frozenset()):
+        """
+        _referenced_names: named types used by a type expression, following local aliases
+        """
+        kind = type_expr[0]
+        if kind == 'name':
+            name = type_expr[1]
+            alias = self.typedefs.get(name)
+            if alias is not None and alias[0] != 'structure' and name not in seen:
+                return [name] + self._referenced_names(alias, seen | {name})
+            return [name]
+        if kind == 'list':
+            return self._referenced_names(type_expr[1], seen)
+        if kind == 'mapping':
+            return (self._referenced_names(type_expr[1], seen) +
+                    self._referenced_names(type_expr[2], seen))
+        if kind == 'tuple':
+            return [name for item in type_expr[1] for name in self._referenced_names(item, seen)]
+        return []
+
+    def find_generics_fields(self, type_name, generics_types):
+        """
+        find_generics_fields: map each field of a structure that holds a generics type
+                              to that generics type
+
+        e.g. {'data': 'FloatMatrix2D'} for a structure with a "FloatMatrix2D data;" field
+        """
+        type_expr = self.typedefs.get(type_name)
+        if type_expr is None or type_expr[0] != 'structure':
+            raise ValueError('Cannot find structure {} in spec'.format(type_name))
+
+        generics_fields = dict()
+        for field_name, field_type in type_expr[1]:
+            for name in self._referenced_names(field_type):
+                short_name = name.split('.')[-1]
+                if short_name in generics_types:
+                    generics_fields[field_name] = short_name
+                    break
+        return generics_fields
+
+    def unresolved_names(self, type_name):
+        """
+        unresolved_names: unqualified names used by a structure that are not defined in this spec
+        """
+        type_expr = self.typedefs.get(type_name)
+        if type_expr is None:
+            return {type_name}
+        if type_expr[0] != 'structure':
+            return set()
+        return {name for _, field_type in type_expr[1]
+                for name in self._referenced_names(field_type)
+                if '.' not in name and name not in KIDL_BUILTINS and name not in self.typedefs}
+
+
+class GenericsTypeCache(object):
+    '''
+    Memoizes the generics module found for workspace type strings.
+
+    Only fully versioned type strings are cached since the spec of a type version never changes.
+    Parsed module specs are kept by module version to resolve types that use module typedefs.
+    If cache_file is given the cache is loaded from and saved to that file.
+    '''
+
+    def __init__(self, cache_file=None):
+        self._cache_file = cache_file
+        self._cache = dict()
+        self._module_models = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file) as f:
+                    self._cache = json.load(f)
+            except (OSError, ValueError):
+                logging.warning('Cannot load generics type cache {}'.format(cache_file))
+
+    def get(self, obj_type):
+        with self._lock:
+            generics_module = self._cache.get(obj_type)
+            if generics_module is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(generics_module)
+
+    def add(self, obj_type, generics_module):
+        if not VERSIONED_TYPE.match(obj_type):
+            return
+        with self._lock:
+            self._cache[obj_type] = dict(generics_module)
+            if self._cache_file:
+                self._save()
+
+    def _save(self):
+        tmp_file = '{}.{}.tmp'.format(self._cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self._cache, f)
+            os.replace(tmp_file, self._cache_file)
+        except OSError:
+            logging.warning('Cannot save generics type cache {}'.format(self._cache_file))
+
+    def get_module_model(self, module, version):
+        with self._lock:
+            return self._module_models.get((module, version))
+
+    def add_module_model(self, module, version, spec_model):
+        with self._lock:
+            self._module_models[(module, version)] = spec_model
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._cache),
+                    'module_specs': len(self._module_models),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+_type_cache = None
+_type_cache_lock = threading.Lock()
+
+
+def get_type_cache(config):
+    """
+    get_type_cache: return the process-wide generics type cache, creating it on first use
+    """
+    global _type_cache
+    with _type_cache_lock:
+        if _type_cache is None:
+            cache_file = None
+            if config.get('type-cache-persist', 'false').lower() == 'true':
+                cache_file = os.path.join(config['scratch'], TYPE_CACHE_FILE)
+            _type_cache = GenericsTypeCache(cache_file)
+        return _type_cache
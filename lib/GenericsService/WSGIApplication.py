@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# The WSGI entry point of the service. GenericsServiceServer.py is generated by kb-sdk compile
+# and rewritten on every build, so the changes to how requests are served live here, in a
+# subclass of its Application: JSON-RPC batches, streamed and compressed responses, the orjson
+# encoder and the pooled auth client sharing validated tokens between workers.
+import json
+import os
+import random as _random
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from getopt import getopt, GetoptError
+from wsgiref.simple_server import make_server
+
+from jsonrpcbase import JSONRPCError
+from jsonrpcbase import ServerError as JSONServerError
+
+from biokbase import log
+from GenericsService import GenericsServiceServer as _server
+from GenericsService.Compression import get_response_compressor
+from GenericsService.GenericsServiceServer import MethodContext, getIPAddress
+from GenericsService.JSONEncoding import encode_chunks, get_json_encoder
+from GenericsService.ObjectCache import ObjectScope
+from GenericsService.SharedCache import get_shared_cache
+from installed_clients.authclient import KBaseAuth as _KBaseAuth
+
+config = _server.config
+
+json_encode = get_json_encoder(config.get('json-encoder') if config else None)
+# matrix values are streamed in chunks of about this size, 0 sends responses in one piece
+response_chunk_bytes = int(config.get('response-chunk-kb', 1024) if config else 1024) * 1024
+# threads running the requests of JSON-RPC batches, shared by all batches of a worker
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(config.get('batch-threads', 4) if config else 4))
+
+
+class Application(_server.Application):
+    '''
+    The generated Application serving JSON-RPC batches concurrently, with responses encoded by
+    json_encode, streamed in chunks and compressed as negotiated with the client.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        authurl = config.get(_server.AUTH) if config else None
+        self.auth_client = _KBaseAuth(authurl, shared_cache=get_shared_cache(config))
+        self.compressor = get_response_compressor(config)
+
+    def encode_result(self, result):
+        """
+        encode_result: encode the result of a method call as UTF-8 JSON chunks
+
+        returns a list of chunks, or an iterator of chunks encoded as they are sent for results
+        larger than response_chunk_bytes
+        """
+        if result is None:
+            return None
+        if response_chunk_bytes:
+            return encode_chunks(result, json_encode, response_chunk_bytes)
+        return [json_encode(result)]
+
+    def stream_result(self, ctx, chunks):
+        try:
+            yield from chunks
+        except Exception:
+            # the status and headers are sent already, the client gets a truncated body
+            self.log(log.ERR, ctx, traceback.format_exc().split('\n')[0:-1])
+            raise
+        self.log(log.INFO, ctx, 'end method')
+
+    def __call__(self, environ, start_response):
+        # Context object, equivalent to the perl impl CallContext
+        ctx = MethodContext(self.userlog)
+        ctx['client_ip'] = getIPAddress(environ)
+        status = '500 Internal Server Error'
+
+        try:
+            body_size = int(environ.get('CONTENT_LENGTH', 0))
+        except (ValueError):
+            body_size = 0
+        if environ['REQUEST_METHOD'] == 'OPTIONS':
+            # we basically do nothing and just return headers
+            status = '200 OK'
+            rpc_result = ""
+        else:
+            request_body = environ['wsgi.input'].read(body_size)
+            try:
+                req = json.loads(request_body)
+            except ValueError as ve:
+                err = {'error': {'code': -32700,
+                                 'name': "Parse error",
+                                 'message': str(ve),
+                                 }
+                       }
+                rpc_result = self.process_error(err, ctx, {'version': '1.1'})
+            else:
+                if isinstance(req, list) and req:
+                    status = '200 OK'
+                    rpc_result = self.process_batch(environ, req)
+                elif self.is_request(req):
+                    status, rpc_result = self.process_request(environ, ctx, req)
+                else:
+                    # e.g. an empty batch
+                    rpc_result = self.invalid_request(
+                        ctx, req, 'Request is not a JSON-RPC request object')
+
+        if rpc_result:
+            response_body = rpc_result
+        else:
+            response_body = ''
+        if isinstance(response_body, str):
+            response_body = response_body.encode('utf8')
+        if isinstance(response_body, bytes):
+            response_body = [response_body]
+
+        content_encoding = self.compressor.negotiate(environ.get('HTTP_ACCEPT_ENCODING'))
+        if content_encoding:
+            response_body, content_encoding = self.compressor.compress(response_body,
+                                                                       content_encoding)
+
+        response_headers = [
+            ('Access-Control-Allow-Origin', '*'),
+            ('Access-Control-Allow-Headers', environ.get(
+                'HTTP_ACCESS_CONTROL_REQUEST_HEADERS', 'authorization')),
+            ('content-type', 'application/json'),
+            ('vary', 'Accept-Encoding')]
+        if content_encoding:
+            response_headers.append(('content-encoding', content_encoding))
+        if isinstance(response_body, list):
+            response_headers.append(
+                ('content-length', str(sum(len(chunk) for chunk in response_body))))
+        # without a content-length the uwsgi http router sends the chunks of a streamed response
+        # with chunked transfer encoding, as started with --http-auto-chunked, see the Makefile.
+        # Otherwise the end of the response is marked by closing the connection
+        start_response(status, response_headers)
+        return response_body
+
+    @staticmethod
+    def is_request(req):
+        return (isinstance(req, dict) and isinstance(req.get('method'), str) and
+                req['method'].count('.') == 1)
+
+    def invalid_request(self, ctx, req, message):
+        err = {'error': {'code': -32600,
+                         'name': 'Invalid Request',
+                         'message': message,
+                         }
+               }
+        return self.process_error(err, ctx, req if isinstance(req, dict) else {'version': '1.1'})
+
+    def process_request(self, environ, ctx, req):
+        status = '500 Internal Server Error'
+        ctx['module'], ctx['method'] = req['method'].split('.')
+        ctx['call_id'] = req.get('id')
+        ctx['rpc_context'] = {
+            'call_stack': [{'time': self.now_in_utc(),
+                            'method': req['method']}
+                           ]
+        }
+        prov_action = {'service': ctx['module'],
+                       'method': ctx['method'],
+                       'method_params': req.get('params')
+                       }
+        ctx['provenance'] = [prov_action]
+        try:
+            token = environ.get('HTTP_AUTHORIZATION')
+            # parse out the method being requested and check if it
+            # has an authentication requirement
+            method_name = req['method']
+            auth_req = self.method_authentication.get(
+                method_name, 'none')
+            if auth_req != 'none':
+                if token is None and auth_req == 'required':
+                    err = JSONServerError()
+                    err.data = (
+                        'Authentication required for ' +
+                        'GenericsService ' +
+                        'but no authentication header was passed')
+                    raise err
+                elif token is None and auth_req == 'optional':
+                    pass
+                else:
+                    try:
+                        user = self.auth_client.get_user(token)
+                        ctx['user_id'] = user
+                        ctx['authenticated'] = 1
+                        ctx['token'] = token
+                    except Exception as e:
+                        if auth_req == 'required':
+                            err = JSONServerError()
+                            err.data = \
+                                "Token validation failed: %s" % e
+                            raise err
+            if (environ.get('HTTP_X_FORWARDED_FOR')):
+                self.log(log.INFO, ctx, 'X-Forwarded-For: ' +
+                         environ.get('HTTP_X_FORWARDED_FOR'))
+            self.log(log.INFO, ctx, 'start method')
+            rpc_result = self.encode_result(self.rpc_service.call_py(ctx, req))
+            if rpc_result is None or isinstance(rpc_result, list):
+                self.log(log.INFO, ctx, 'end method')
+            else:
+                rpc_result = self.stream_result(ctx, rpc_result)
+            status = '200 OK'
+        except JSONRPCError as jre:
+            err = {'error': {'code': jre.code,
+                             'name': jre.message,
+                             'message': jre.data
+                             }
+                   }
+            trace = jre.trace if hasattr(jre, 'trace') else None
+            rpc_result = self.process_error(err, ctx, req, trace)
+        except Exception:
+            err = {'error': {'code': 0,
+                             'name': 'Unexpected Server Error',
+                             'message': 'An unexpected server error ' +
+                                        'occurred',
+                             }
+                   }
+            rpc_result = self.process_error(err, ctx, req,
+                                            traceback.format_exc())
+        return status, rpc_result
+
+    def process_batch(self, environ, reqs):
+        # the requests of a batch run concurrently and share the objects they retrieve, so a
+        # matrix used by several of them is downloaded once
+        object_scope = ObjectScope()
+
+        def process_item(req):
+            ctx = MethodContext(self.userlog)
+            ctx['client_ip'] = getIPAddress(environ)
+            ctx['object_scope'] = object_scope
+            if not self.is_request(req):
+                return self.invalid_request(
+                    ctx, req, 'Batch item is not a JSON-RPC request object').encode('utf8')
+            _, rpc_result = self.process_request(environ, ctx, req)
+            if req.get('id') is None or rpc_result is None:
+                # notifications, requests without an id or with a null id, get no response
+                return None
+            if isinstance(rpc_result, str):
+                return rpc_result.encode('utf8')
+            return b''.join(rpc_result)
+
+        results = [result for result in batch_executor.map(process_item, reqs)
+                   if result is not None]
+        if not results:
+            # notifications only
+            return ''
+        return [b'[' + b','.join(results) + b']']
+
+
+application = Application()
+
+try:
+    import uwsgi
+    # the generated server module registered its own application on import
+    uwsgi.applications = {'': application}
+except ImportError:
+    # Not available outside of wsgi, ignore
+    pass
+
+
+def process_async_cli(input_file_path, output_file_path, token):
+    exit_code = 0
+    with open(input_file_path) as data_file:
+        req = json.load(data_file)
+    if 'version' not in req:
+        req['version'] = '1.1'
+    if 'id' not in req:
+        req['id'] = str(_random.random())[2:]
+    ctx = MethodContext(application.userlog)
+    if token:
+        user = application.auth_client.get_user(token)
+        ctx['user_id'] = user
+        ctx['authenticated'] = 1
+        ctx['token'] = token
+    if 'context' in req:
+        ctx['rpc_context'] = req['context']
+    ctx['CLI'] = 1
+    ctx['module'], ctx['method'] = req['method'].split('.')
+    prov_action = {'service': ctx['module'], 'method': ctx['method'],
+                   'method_params': req['params']}
+    ctx['provenance'] = [prov_action]
+    resp = None
+    try:
+        resp = application.rpc_service.call_py(ctx, req)
+    except JSONRPCError as jre:
+        trace = jre.trace if hasattr(jre, 'trace') else None
+        resp = {'id': req['id'],
+                'version': req['version'],
+                'error': {'code': jre.code,
+                          'name': jre.message,
+                          'message': jre.data,
+                          'error': trace}
+                }
+    except Exception:
+        trace = traceback.format_exc()
+        resp = {'id': req['id'],
+                'version': req['version'],
+                'error': {'code': 0,
+                          'name': 'Unexpected Server Error',
+                          'message': 'An unexpected server error occurred',
+                          'error': trace}
+                }
+    if 'error' in resp:
+        exit_code = 500
+    with open(output_file_path, "wb") as f:
+        for chunk in encode_chunks(resp, json_encode, response_chunk_bytes or 1024 * 1024):
+            f.write(chunk)
+    return exit_code
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) >= 3 and len(sys.argv) <= 4 and
+            os.path.isfile(sys.argv[1])):
+        token = None
+        if len(sys.argv) == 4:
+            if os.path.isfile(sys.argv[3]):
+                with open(sys.argv[3]) as token_file:
+                    token = token_file.read()
+            else:
+                token = sys.argv[3]
+        sys.exit(process_async_cli(sys.argv[1], sys.argv[2], token))
+    try:
+        opts, args = getopt(sys.argv[1:], "", ["port=", "host="])
+    except GetoptError as err:
+        print(str(err))
+        sys.exit(2)
+    port = 9999
+    host = 'localhost'
+    for o, a in opts:
+        if o == '--port':
+            port = int(a)
+        elif o == '--host':
+            host = a
+            print("Host set to %s" % host)
+        else:
+            assert False, "unhandled option"
+
+    httpd = make_server(host, port, application)
+    print("Listening on port %s" % httpd.server_address[1])
+    httpd.serve_forever()
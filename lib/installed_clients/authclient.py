@@ -6,53 +6,99 @@ A very basic KBase auth client for the Python server.
 @author: gaprice@lbl.gov
 '''
 import time as _time
-import requests as _requests
 import threading as _threading
 import hashlib
+from collections import OrderedDict as _OrderedDict
+# the following is a hack to get the baseclient to import whether we're in a
+# package or not. This makes pep8 unhappy hence the annotations.
+try:
+    # baseclient and this client are in a package
+    from .baseclient import post as _post  # @UnusedImport
+except ImportError:
+    # no they aren't
+    from baseclient import post as _post  # @Reimport
 
 
 class TokenCache(object):
-    ''' A basic cache for tokens. '''
+    '''
+    An LRU cache for tokens with expiring entries.
+
+    Entries are spread over several independently locked stripes by token
+    hash. Tokens rejected by the auth service with a 401 or 403 are kept for a
+    shorter time so that repeated requests with a bad token do not reach the
+    service.
+    '''
 
     _MAX_TIME_SEC = 5 * 60  # 5 min
+    _REJECTED_TIME_SEC = 30
+    _STRIPES = 16
 
-    _lock = _threading.RLock()
+    def __init__(self, maxsize=2000, stripes=_STRIPES):
+        self._stripes = [(_threading.Lock(), _OrderedDict())
+                         for _ in range(stripes)]
+        self._stripe_maxsize = max(1, -(-maxsize // stripes))
 
-    def __init__(self, maxsize=2000):
-        self._cache = {}
-        self._maxsize = maxsize
-        self._halfmax = maxsize / 2  # int division to round down
+    @staticmethod
+    def _hash(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def _stripe(self, token_hash):
+        return self._stripes[token_hash[0] % len(self._stripes)]
+
+    def lookup(self, token):
+        '''
+        Returns (user, None) for a valid token, (None, error) for a rejected
+        token or None if the token is not cached.
+        '''
+        token_hash = self._hash(token)
+        lock, cache = self._stripe(token_hash)
+        with lock:
+            entry = cache.get(token_hash)
+            if entry is None:
+                return None
+            user, error, expires = entry
+            if _time.time() > expires:
+                del cache[token_hash]
+                return None
+            cache.move_to_end(token_hash)
+            return user, error
 
     def get_user(self, token):
-        token = hashlib.sha256(token.encode('utf-8')).hexdigest()
-        with self._lock:
-            usertime = self._cache.get(token)
-        if not usertime:
-            return None
-
-        user, intime = usertime
-        if _time.time() - intime > self._MAX_TIME_SEC:
-            return None
-        return user
+        entry = self.lookup(token)
+        return entry[0] if entry else None
+
+    def _add(self, token, user, error, ttl):
+        token_hash = self._hash(token)
+        lock, cache = self._stripe(token_hash)
+        with lock:
+            cache[token_hash] = (user, error, _time.time() + ttl)
+            cache.move_to_end(token_hash)
+            while len(cache) > self._stripe_maxsize:
+                cache.popitem(last=False)
 
     def add_valid_token(self, token, user):
         if not token:
             raise ValueError('Must supply token')
         if not user:
             raise ValueError('Must supply user')
-        token = hashlib.sha256(token.encode('utf-8')).hexdigest()
-        with self._lock:
-            self._cache[token] = [user, _time.time()]
-            if len(self._cache) > self._maxsize:
-                sorted_items = sorted(
-                    list(self._cache.items()),
-                    key=(lambda v: v[1][1])
-                )
-                for i, (t, _) in enumerate(sorted_items):
-                    if i <= self._halfmax:
-                        del self._cache[t]
-                    else:
-                        break
+        self._add(token, user, None, self._MAX_TIME_SEC)
+
+    def add_rejected_token(self, token, error):
+        if not token:
+            raise ValueError('Must supply token')
+        self._add(token, None, error, self._REJECTED_TIME_SEC)
+
+    def __len__(self):
+        return sum(len(cache) for _, cache in self._stripes)
+
+
+class _Validation(object):
+    ''' A token validation in progress, shared by concurrent requests. '''
+
+    def __init__(self):
+        self.done = _threading.Event()
+        self.user = None
+        self.error = None
 
 
 class KBaseAuth(object):
@@ -62,33 +108,92 @@ class KBaseAuth(object):
 
     _LOGIN_URL = 'https://kbase.us/services/auth/api/legacy/KBase/Sessions/Login'
 
-    def __init__(self, auth_url=None):
+    def __init__(self, auth_url=None, shared_cache=None):
         '''
         Constructor
+
+        shared_cache: an optional cache shared with other processes with
+        get(key) and set(key, value, ttl) methods
         '''
         self._authurl = auth_url
         if not self._authurl:
             self._authurl = self._LOGIN_URL
         self._cache = TokenCache()
+        self._shared_cache = shared_cache
+        self._validations = {}
+        self._validations_lock = _threading.Lock()
 
     def get_user(self, token):
         if not token:
             raise ValueError('Must supply token')
-        user = self._cache.get_user(token)
-        if user:
+        entry = self._cache.lookup(token)
+        if entry:
+            user, error = entry
+            if error:
+                raise ValueError(error)
             return user
 
+        if self._shared_cache is not None:
+            entry = self._shared_cache.get(self._shared_key(token))
+            if entry:
+                user, error = entry
+                if error:
+                    self._cache.add_rejected_token(token, error)
+                    raise ValueError(error)
+                self._cache.add_valid_token(token, user)
+                return user
+
+        # concurrent requests with the same uncached token wait for the
+        # first one to validate it
+        with self._validations_lock:
+            validation = self._validations.get(token)
+            validating = validation is None
+            if validating:
+                validation = self._validations[token] = _Validation()
+        if not validating:
+            validation.done.wait()
+            if validation.error:
+                raise validation.error
+            return validation.user
+
+        try:
+            validation.user = self._validate(token)
+            return validation.user
+        except Exception as e:
+            validation.error = e
+            raise
+        finally:
+            with self._validations_lock:
+                del self._validations[token]
+            validation.done.set()
+
+    def _validate(self, token):
         d = {'token': token, 'fields': 'user_id'}
-        ret = _requests.post(self._authurl, data=d)
+        ret = _post(self._authurl, data=d)
         if not ret.ok:
             try:
                 err = ret.json()
             except Exception as e:
                 ret.raise_for_status()
-            raise ValueError('Error connecting to auth service: {} {}\n{}'
-                             .format(ret.status_code, ret.reason,
-                                     err['error']['message']))
+            error = ('Error connecting to auth service: {} {}\n{}'
+                     .format(ret.status_code, ret.reason,
+                             err['error']['message']))
+            if ret.status_code in (401, 403):
+                # the token was rejected, other errors, e.g. rate limits, are
+                # not about the token and not cached
+                self._cache.add_rejected_token(token, error)
+                if self._shared_cache is not None:
+                    self._shared_cache.set(self._shared_key(token), [None, error],
+                                           TokenCache._REJECTED_TIME_SEC)
+            raise ValueError(error)
 
         user = ret.json()['user_id']
         self._cache.add_valid_token(token, user)
+        if self._shared_cache is not None:
+            self._shared_cache.set(self._shared_key(token), [user, None],
+                                   TokenCache._MAX_TIME_SEC)
         return user
+
+    @staticmethod
+    def _shared_key(token):
+        return 'token:' + hashlib.sha256(token.encode('utf-8')).hexdigest()
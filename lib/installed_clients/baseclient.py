@@ -11,8 +11,12 @@ import json as _json
 import requests as _requests
 import random as _random
 import os as _os
+import threading as _threading
 import traceback as _traceback
+from requests.adapters import HTTPAdapter as _HTTPAdapter
 from requests.exceptions import ConnectionError
+from urllib3.connectionpool import HTTPConnectionPool as _HTTPConnectionPool
+from urllib3.connectionpool import HTTPSConnectionPool as _HTTPSConnectionPool
 from urllib3.exceptions import ProtocolError
 
 try:
@@ -26,10 +30,165 @@ except ImportError:
     from urlparse import urlparse as _urlparse  # py2
 import time
 
+try:
+    import ijson as _ijson
+except ImportError:
+    _ijson = None
+
 _CT = 'content-type'
 _AJ = 'application/json'
 _URL_SCHEME = frozenset(['http', 'https'])
 _CHECK_JOB_RETRYS = 3
+_STREAM_CHUNK_SIZE = 1024 * 1024
+
+# connection pool settings shared by all clients, see configure_connection_pool
+_pool_config = {'pool_connections': 10, 'pool_maxsize': 10, 'keep_alive': True}
+_session_local = _threading.local()
+_stats_lock = _threading.Lock()
+_connection_stats = {'requests': 0, 'connections_opened': 0}
+
+
+def _count(stat):
+    with _stats_lock:
+        _connection_stats[stat] += 1
+
+
+class _CountingHTTPConnectionPool(_HTTPConnectionPool):
+
+    def _new_conn(self):
+        _count('connections_opened')
+        return super(_CountingHTTPConnectionPool, self)._new_conn()
+
+
+class _CountingHTTPSConnectionPool(_HTTPSConnectionPool):
+
+    def _new_conn(self):
+        _count('connections_opened')
+        return super(_CountingHTTPSConnectionPool, self)._new_conn()
+
+
+class _CountingHTTPAdapter(_HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_CountingHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool}
+
+
+def configure_connection_pool(pool_connections=None, pool_maxsize=None,
+                              keep_alive=None):
+    '''
+    Configure the HTTP connection pools used by all clients.
+    Sessions that already exist keep their settings, so call this before
+    making any requests.
+    pool_connections - the number of hosts to keep connection pools for.
+    pool_maxsize - the number of connections kept open per host.
+    keep_alive - if False, close each connection after its request.
+    '''
+    if pool_connections is not None:
+        _pool_config['pool_connections'] = int(pool_connections)
+    if pool_maxsize is not None:
+        _pool_config['pool_maxsize'] = int(pool_maxsize)
+    if keep_alive is not None:
+        _pool_config['keep_alive'] = keep_alive
+
+
+def get_session():
+    '''
+    Get the requests Session of the current thread. Sessions keep their
+    connections open between calls, so repeated calls to the same service
+    skip the TCP and TLS handshakes.
+    '''
+    session = getattr(_session_local, 'session', None)
+    if session is None:
+        session = _requests.Session()
+        adapter = _CountingHTTPAdapter(
+            pool_connections=_pool_config['pool_connections'],
+            pool_maxsize=_pool_config['pool_maxsize'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not _pool_config['keep_alive']:
+            session.headers['Connection'] = 'close'
+        _session_local.session = session
+    return session
+
+
+def post(url, **kwargs):
+    '''
+    POST with the pooled session of the current thread.
+    '''
+    _count('requests')
+    return get_session().post(url, **kwargs)
+
+
+def connection_stats():
+    '''
+    Get the number of requests made through the pooled sessions and the number
+    of connections opened for them. Every other request reused a connection.
+    '''
+    with _stats_lock:
+        stats = dict(_connection_stats)
+    stats['connections_reused'] = max(
+        stats['requests'] - stats['connections_opened'], 0)
+    return stats
+
+
+def _load_stream(chunks, hooks):
+    '''
+    Decode a JSON document from an iterable of bytes chunks as they arrive.
+    hooks maps the ijson prefix of arrays in the document, e.g.
+    'result.item.data', to a function returning a builder for them. A builder
+    is fed the (event, value) pairs following the start of its array with
+    feed(events, start), which returns the position after the end of the
+    array in events, or None if the array continues in the next chunk. Its
+    result() is used in place of the array.
+    Without ijson the document is decoded at once and the hooks are not used.
+    '''
+    if _ijson is None:
+        return _json.loads(b''.join(chunks))
+
+    events = _ijson.sendable_list()
+    parser = _ijson.basic_parse_coro(events, use_float=True)
+    builder = _ijson.ObjectBuilder()
+    # the prefix of the current value, as a list of map keys and 'item'
+    path = []
+    hook = None
+
+    def build(hook):
+        pos = 0
+        while pos < len(events):
+            if hook is not None:
+                pos = hook.feed(events, pos)
+                if pos is None:
+                    break
+                # any scalar event adds the value to the current container
+                builder.event('null', hook.result())
+                hook = None
+                continue
+            event, value = events[pos]
+            pos += 1
+            if event == 'map_key':
+                path[-1] = value
+            elif event == 'start_map':
+                path.append(None)
+            elif event == 'start_array':
+                if '.'.join(path) in hooks:
+                    hook = hooks['.'.join(path)]()
+                    continue
+                path.append('item')
+            elif event in ('end_map', 'end_array'):
+                path.pop()
+            builder.event(event, value)
+        del events[:]
+        return hook
+
+    for chunk in chunks:
+        parser.send(chunk)
+        hook = build(hook)
+    parser.close()
+    build(hook)
+    return builder.value
 
 
 def _get_token(user_id, password, auth_svc):
@@ -164,7 +323,7 @@ class BaseClient(object):
         if self.timeout < 1:
             raise ValueError('Timeout value must be at least 1 second')
 
-    def _call(self, url, method, params, context=None):
+    def _call(self, url, method, params, context=None, stream_hooks=None):
         arg_hash = {'method': method,
                     'params': params,
                     'version': '1.1',
@@ -176,9 +335,10 @@ class BaseClient(object):
             arg_hash['context'] = context
 
         body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(url, data=body, headers=self._headers,
-                             timeout=self.timeout,
-                             verify=not self.trust_all_ssl_certificates)
+        ret = post(url, data=body, headers=self._headers,
+                   timeout=self.timeout,
+                   verify=not self.trust_all_ssl_certificates,
+                   stream=stream_hooks is not None)
         ret.encoding = 'utf-8'
         if ret.status_code == 500:
             if ret.headers.get(_CT) == _AJ:
@@ -191,7 +351,16 @@ class BaseClient(object):
                 raise ServerError('Unknown', 0, ret.text)
         if not ret.ok:
             ret.raise_for_status()
-        resp = ret.json()
+        if stream_hooks is None:
+            resp = ret.json()
+        else:
+            # the connection goes back to the pool once the body is read
+            # or the decoding fails
+            try:
+                resp = _load_stream(ret.iter_content(_STREAM_CHUNK_SIZE),
+                                    stream_hooks)
+            finally:
+                ret.close()
         if 'result' not in resp:
             raise ServerError('Unknown', 0, 'An unknown server error occurred')
         if not resp['result']:
@@ -266,7 +435,7 @@ class BaseClient(object):
             check_job_failures))
 
     def call_method(self, service_method, args, service_ver=None,
-                    context=None):
+                    context=None, stream_hooks=None):
         '''
         Call a standard or dynamic service synchronously.
         Required arguments:
@@ -276,7 +445,9 @@ class BaseClient(object):
         service_ver - the version of the service to run, e.g. a git hash
             or dev/beta/release.
         context - the rpc context dict.
+        stream_hooks - builders of arrays in the response, which is then
+            decoded as it is read, see _load_stream.
         '''
         url = self._get_service_url(service_method, service_ver)
         context = self._set_up_context(service_ver, context)
-        return self._call(url, service_method, args, context)
+        return self._call(url, service_method, args, context, stream_hooks)
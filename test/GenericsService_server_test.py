@@ -1,16 +1,31 @@
 # -*- coding: utf-8 -*-
+import base64
+import gzip
 import inspect
+import io
 import json
 import os
 import time
+import tracemalloc
 import unittest
 from configparser import ConfigParser
+import numpy as np
 import pandas as pd
 
+from GenericsService.Attributes import AttributeIndex
+from GenericsService.Compression import ResponseCompressor
+from GenericsService.Fetch import ATTRIBUTE_PATHS, MATRIX_VALUES_PREFIX, VERSIONED_REF, Fetch
 from GenericsService.GenericsServiceImpl import GenericsService
 from GenericsService.GenericsServiceServer import MethodContext
+from GenericsService.JSONEncoding import JSON_ENCODERS, encode_chunks, get_json_encoder
+from GenericsService.Matrix import Matrix, MatrixValues, ValuesBuilder
+from GenericsService.MatrixStore import MatrixStore
+from GenericsService.ObjectCache import InflightDownloads, ObjectCache, ObjectScope
+from GenericsService.SharedCache import MmapSharedCache
+from GenericsService.WSGIApplication import application
 from GenericsService.authclient import KBaseAuth as _KBaseAuth
 
+from installed_clients import baseclient
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.GenomeFileUtilClient import GenomeFileUtil
 from installed_clients.WorkspaceClient import Workspace
@@ -368,3 +383,362 @@ class GenericsServiceTest(unittest.TestCase):
         expected_ids = ['instance_1', 'instance_2', 'instance_3', 'instance_4']
 
         self.assertCountEqual(selected_ids, expected_ids)
+
+    def test_object_cache(self):
+        self.start_test()
+        params = {'matrix_ref': self.fitness_matrix_ref}
+        self.serviceImpl.fetch_data_by_ids(self.ctx, params)
+        hits = self.serviceImpl.status(self.ctx)[0]['object_cache']['hits']
+
+        returnVal = self.serviceImpl.fetch_data_by_ids(self.ctx, params)[0]
+        cache_stats = self.serviceImpl.status(self.ctx)[0]['object_cache']
+        self.assertGreater(cache_stats['hits'], hits)
+        self.assertEqual(returnVal['data']['row_ids'], self.row_ids)
+
+    def test_fetch_all_caches_matrix_for_fetch_data_by_ids(self):
+        self.start_test()
+        params = {'matrix_ref': self.expression_matrix_ref}
+        self.serviceImpl.fetch_all(self.ctx, params)
+        misses = self.serviceImpl.status(self.ctx)[0]['object_cache']['misses']
+
+        # the matrix is retrieved with the same paths by both methods
+        self.serviceImpl.fetch_data_by_ids(self.ctx, params)
+        self.assertEqual(self.serviceImpl.status(self.ctx)[0]['object_cache']['misses'], misses)
+
+    def test_object_cache_paths(self):
+        self.start_test()
+        cache = ObjectCache(100)
+        cache.add(('1/2/3', ('data',), None), {'data': {}}, 40)
+        cache.add(('1/2/3', None, None), {'data': {}, 'scale': 'raw'}, 40)
+        cache.add(('1/2/4', ('data',), None), {'data': {}}, 10)
+        self.assertEqual(set(cache.paths('1/2/3', None)), {('data',), None})
+        self.assertEqual(cache.paths('1/2/3', Fetch._decode_matrix), [])
+
+        # evicted entries are dropped from the paths
+        cache.add(('1/2/5', None, None), {}, 40)
+        self.assertEqual(cache.paths('1/2/3', None), [None])
+
+        # a later request for a part of a cached object uses the cached object
+        fetch = Fetch(self.cfg, self.ctx)
+        fetch._retrieve_object(self.expression_matrix_ref, ['data'])
+        misses = fetch.object_cache.stats()['misses']
+        fetch = Fetch(self.cfg, self.ctx)
+        _, matrix_data = fetch._retrieve_object(self.expression_matrix_ref, ['data/row_ids'])
+        self.assertEqual(matrix_data['data']['row_ids'], self.row_ids)
+        self.assertEqual(fetch.object_cache.stats()['misses'], misses)
+
+    def test_json_encoders(self):
+        self.start_test()
+        params = {'matrix_ref': self.expression_matrix_ref}
+        returnVal = self.serviceImpl.fetch_data_by_ids(self.ctx, params)[0]
+
+        expected_values = [[0.1, 0.2, 0.3, 0.4],
+                           [0.3, 0.4, 0.5, 0.6],
+                           [None, None, None, None]]
+        for name in JSON_ENCODERS:
+            encoded = get_json_encoder(name)({'result': [returnVal]})
+            data = json.loads(encoded)['result'][0]['data']
+            self.assertEqual(data['values'], expected_values)
+
+    def test_fetch_data_by_ids_npy(self):
+        self.start_test()
+        params = {'matrix_ref': self.expression_matrix_ref,
+                  'col_ids': ['instance_1', 'instance_2'],
+                  'format': 'npy_base64'}
+        returnVal = self.serviceImpl.fetch_data_by_ids(self.ctx, params)[0]
+        self.assertNotIn('data', returnVal)
+        binary_data = returnVal['binary_data']
+
+        self.assertEqual(binary_data['format'], 'npy_base64')
+        self.assertEqual(binary_data['col_ids'], ['instance_1', 'instance_2'])
+        values = np.load(io.BytesIO(base64.b64decode(binary_data['values'])))
+        self.assertEqual(values.shape, (3, 2))
+        self.assertEqual(values[:2].tolist(), [[0.1, 0.2], [0.3, 0.4]])
+        self.assertTrue(np.isnan(values[2]).all())
+
+        with self.assertRaises(ValueError) as context:
+            params['format'] = 'xml'
+            self.serviceImpl.fetch_data_by_ids(self.ctx, params)
+        self.assertIn('Unknown matrix format', str(context.exception.args))
+
+    def test_encode_chunks(self):
+        self.start_test()
+        params = {'matrix_ref': self.expression_matrix_ref}
+        returnVal = self.serviceImpl.fetch_all(self.ctx, params)[0]
+
+        for name in JSON_ENCODERS:
+            json_encode = get_json_encoder(name)
+            chunks = list(encode_chunks({'result': [returnVal]}, json_encode, 1))
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(json.loads(b''.join(chunks)),
+                             json.loads(json_encode({'result': [returnVal]})))
+            # results smaller than a chunk are encoded at once
+            chunks = encode_chunks({'result': [returnVal]}, json_encode, 1024 * 1024)
+            self.assertIsInstance(chunks, list)
+            self.assertEqual(json.loads(b''.join(chunks)),
+                             json.loads(json_encode({'result': [returnVal]})))
+
+    def test_response_compression(self):
+        self.start_test()
+        compressor = ResponseCompressor(['gzip', 'deflate'], 1024)
+        self.assertEqual(compressor.negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(compressor.negotiate('gzip;q=0.5, deflate'), 'deflate')
+        self.assertIsNone(compressor.negotiate('identity'))
+        self.assertIsNone(compressor.negotiate(None))
+
+        params = {'matrix_ref': self.expression_matrix_ref}
+        returnVal = self.serviceImpl.fetch_all(self.ctx, params)[0]
+        json_encode = get_json_encoder()
+        chunks = encode_chunks({'result': [returnVal]}, json_encode, 1)
+        body = json_encode({'result': [returnVal]})
+
+        compressed, encoding = compressor.compress(chunks, 'gzip')
+        if len(body) < 1024:
+            self.assertIsNone(encoding)
+            compressed = b''.join(compressed)
+        else:
+            self.assertEqual(encoding, 'gzip')
+            compressed = gzip.decompress(b''.join(compressed))
+        self.assertEqual(json.loads(compressed), json.loads(body))
+
+        compressed, encoding = compressor.compress([body * 100], 'gzip')
+        self.assertEqual(encoding, 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(compressed)), body * 100)
+        self.assertGreater(compressor.stats()['gzip']['ratio'], 1)
+
+    def test_batch_requests(self):
+        self.start_test()
+        request = {'method': 'GenericsService.status', 'params': [], 'version': '1.1'}
+        # requests with a null id and without an id are notifications and get no response
+        batch = [dict(request, id='a'), dict(request, id=None), dict(request), 5,
+                 dict(request, id='b')]
+        body = json.dumps(batch).encode('utf8')
+        environ = {'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body), 'REMOTE_ADDR': '127.0.0.1'}
+        response = dict()
+
+        def start_response(status, headers):
+            response['status'] = status
+
+        results = json.loads(b''.join(application(environ, start_response)))
+        self.assertEqual(response['status'], '200 OK')
+        self.assertEqual([result.get('id') for result in results], ['a', None, 'b'])
+        self.assertIn('result', results[0])
+        self.assertEqual(results[1]['error']['name'], 'Invalid Request')
+        self.assertIn('result', results[2])
+
+    def test_shared_object_scope(self):
+        self.start_test()
+        ctx = MethodContext(None)
+        ctx.update(self.ctx)
+        ctx['object_scope'] = ObjectScope()
+        params = {'matrix_ref': self.fitness_matrix_ref}
+        self.serviceImpl.fetch_data_by_ids(ctx, params)
+        cache_stats = self.serviceImpl.status(ctx)[0]['object_cache']
+
+        # the second request of a batch is served from the scope of the first one
+        self.serviceImpl.fetch_data_by_ids(ctx, params)
+        self.assertEqual(self.serviceImpl.status(ctx)[0]['object_cache'], cache_stats)
+
+    def test_versioned_ref(self):
+        self.start_test()
+        # only infos of refs to a fixed version are shared between workers
+        self.assertTrue(VERSIONED_REF.fullmatch('1/2/3'))
+        for ref in ['1/2', 'my_ws/my_obj', 'my_ws/my_obj/12', '1/my_obj/3', '1/2/3;4/5/6',
+                    '1/2/3/4', '1/2/x']:
+            self.assertIsNone(VERSIONED_REF.fullmatch(ref))
+
+    def test_mmap_shared_cache(self):
+        self.start_test()
+        path = os.path.join(self.scratch, 'test_shared_cache.bin')
+        cache = MmapSharedCache(path, 64 * 1024)
+        cache.set('token:abc', ['user', None], 60)
+        cache.set('expired', 1, -1)
+        # values larger than a slot are not cached
+        cache.set('large', 'x' * cache.max_value_size, 60)
+        self.assertIsNone(cache.get('large'))
+        self.assertEqual(cache.stats()['oversize'], 1)
+
+        # another process maps the same file
+        other_cache = MmapSharedCache(path, 64 * 1024)
+        self.assertEqual(other_cache.get('token:abc'), ['user', None])
+        self.assertIsNone(other_cache.get('expired'))
+        self.assertIsNone(other_cache.get('missing'))
+        self.assertEqual(other_cache.stats()['hits'], 1)
+
+    def test_matrix_store(self):
+        self.start_test()
+        store = MatrixStore(os.path.join(self.scratch, 'test_matrix_store'), 1024 * 1024)
+        matrix = Matrix(['r1', 'r2'], ['c1', 'c2'], np.array([[0.1, np.nan], [0.3, 0.4]]))
+        store.add(('1/2/3', ('data',)), {'data': matrix, 'row_attributemapping_ref': '1/2/4'})
+
+        obj_data = store.get(('1/2/3', ('data',)))
+        self.assertEqual(obj_data['row_attributemapping_ref'], '1/2/4')
+        self.assertIsInstance(obj_data['data'].values, np.memmap)
+        self.assertEqual(obj_data['data'].col_ids, ['c1', 'c2'])
+        # mapped values are charged to the object cache in full
+        self.assertEqual(obj_data['data'].nbytes, 4 * 8 + 4 * 64)
+        self.assertEqual(MatrixValues(obj_data['data'].values), [[0.1, None], [0.3, 0.4]])
+        self.assertIsNone(store.get(('1/2/3', None)))
+
+    def test_matrix_store_backing_store(self):
+        self.start_test()
+        cache = MatrixStore(os.path.join(self.scratch, 'test_matrix_cache'), 1024 * 1024)
+        store = MatrixStore(os.path.join(self.scratch, 'test_matrix_store_2'), 1024 * 1024, cache)
+        attri_index = AttributeIndex.from_instances({'i1': ['a', 1], 'i2': ['b', 2]},
+                                                    ['name', 'number'])
+        store.add(('1/2/5', None), attri_index)
+        matrix = Matrix(['r1'], ['c1', 'c2'], np.array([[0.1, 0.2]]))
+        store.add(('1/2/3', ('data',)), {'data': matrix})
+
+        # a restarted server finds the entries of the backing store
+        store = MatrixStore(os.path.join(self.scratch, 'test_matrix_store_3'), 1024 * 1024, cache)
+        obj_data = store.get(('1/2/3', ('data',)))
+        self.assertIsInstance(obj_data['data'].values, np.memmap)
+        self.assertEqual(MatrixValues(obj_data['data'].values), [[0.1, 0.2]])
+        attri_index = store.get(('1/2/5', None))
+        self.assertEqual(attri_index.to_dict([0, 1]), {'i1': {'name': 'a', 'number': 1},
+                                                       'i2': {'name': 'b', 'number': 2}})
+        self.assertEqual(attri_index.select({'name': ['b']}), ['i2'])
+
+    def test_inflight_downloads(self):
+        self.start_test()
+        inflight_downloads = InflightDownloads()
+        downloads, started = inflight_downloads.join([('1/2/3', None, None)])
+        self.assertEqual(started, [('1/2/3', None, None)])
+
+        # a second request for the same object waits for the first download
+        joined, joined_started = inflight_downloads.join([('1/2/3', None, None)])
+        self.assertEqual(joined_started, [])
+        downloads[('1/2/3', None, None)].result = ('info', 'data')
+        inflight_downloads.finish(downloads, started)
+        self.assertEqual(inflight_downloads.wait(joined[('1/2/3', None, None)]), ('info', 'data'))
+        self.assertEqual(inflight_downloads.stats(),
+                         {'in_progress': 0, 'started': 1, 'saved': 1})
+
+    def test_retrieve_object_groups(self):
+        self.start_test()
+        fetch = Fetch(self.cfg, self.ctx)
+        (matrix_obj,), (attri_obj,) = fetch._retrieve_object_groups(
+            [([self.expression_matrix_ref], ['data/row_ids'], None),
+             ([self.attribute_mapping_ref], ATTRIBUTE_PATHS, AttributeIndex.from_data)])
+        self.assertEqual(matrix_obj[1]['data']['row_ids'],
+                         ['WRI_RS00050_CDS_1', 'WRI_RS00065_CDS_1', 'WRI_RS00070_CDS_1'])
+        self.assertEqual(attri_obj[1].ids,
+                         ['test_instance_1', 'test_instance_2', 'test_instance_3'])
+
+    @unittest.skipIf(baseclient._ijson is None, 'ijson is not installed')
+    def test_stream_decode_matrix_values(self):
+        self.start_test()
+        values = np.arange(2000 * 500, dtype=np.float64).reshape(2000, 500) / 7
+        values[::3, ::5] = np.nan
+        matrix_data = {'row_ids': ['r{}'.format(i) for i in range(2000)],
+                       'col_ids': ['c{}'.format(i) for i in range(500)],
+                       'values': MatrixValues(values).toJSONable()}
+        body = json.dumps({'version': '1.1', 'result': [
+            {'data': [{'info': [], 'data': {'data': matrix_data}}]}]}).encode('utf8')
+        del matrix_data
+
+        def decode(stream):
+            tracemalloc.start()
+            try:
+                if stream:
+                    chunks = (body[pos:pos + 65536] for pos in range(0, len(body), 65536))
+                    resp = baseclient._load_stream(chunks, {MATRIX_VALUES_PREFIX: ValuesBuilder})
+                else:
+                    resp = json.loads(body.decode('utf8'))
+                matrix = Matrix.from_data(resp['result'][0]['data'][0]['data']['data'])
+                return matrix, tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        matrix, peak = decode(stream=False)
+        stream_matrix, stream_peak = decode(stream=True)
+        self.assertTrue(np.array_equal(stream_matrix.values, values, equal_nan=True))
+        self.assertEqual(stream_matrix.row_ids, matrix.row_ids)
+        # the values are held as 8 byte floats, not as lists of python floats and JSON text
+        self.assertLess(stream_peak, peak / 3)
+
+    def test_matrix_from_data(self):
+        self.start_test()
+        matrix = Matrix.from_data({'row_ids': ['r1', 'r2'], 'col_ids': ['c1', 'c2'],
+                                   'values': [[0.1, None], [3, 0.4]]})
+        self.assertEqual(matrix.values.dtype, np.float64)
+        self.assertEqual(matrix.row_index, {'r1': 0, 'r2': 1})
+        df = matrix.to_dataframe()
+        self.assertEqual(df.loc['r2', 'c1'], 3.0)
+        self.assertTrue(np.isnan(df.loc['r1', 'c2']))
+
+        with self.assertRaisesRegex(ValueError, 'Matrix values are not 2 rows of 2 values'):
+            Matrix.from_data({'row_ids': ['r1', 'r2'], 'col_ids': ['c1', 'c2'],
+                              'values': [[0.1, None], [0.3]]})
+
+    def test_attribute_index(self):
+        self.start_test()
+        attri_index = AttributeIndex.from_instances(
+            {'i1': ['a', 1], 'i2': ['b', ['x']], 'i3': ['a'], 'i4': ['b', 1]}, ['name', 'size'])
+        codes, uniques = attri_index.column('name')
+        self.assertEqual(codes.tolist(), [0, 1, 0, 1])
+        self.assertEqual(uniques, ['a', 'b'])
+        self.assertEqual(attri_index.column('size')[0].tolist(), [0, 1, -1, 0])
+
+        self.assertEqual(attri_index.select({'name': ['a']}), ['i1', 'i3'])
+        self.assertEqual(attri_index.select({'name': ['b'], 'size': [1, 2]}), ['i4'])
+        self.assertEqual(attri_index.select({'size': [['x']]}), [])
+        with self.assertRaisesRegex(ValueError, 'Attribute does not contain color'):
+            attri_index.select({'color': ['red']})
+
+        self.assertEqual(list(attri_index.value_counts('size').items()), [(1, 2)])
+        self.assertEqual(attri_index.value_counts('name', [1, 2, 3]), {'b': 2, 'a': 1})
+        self.assertEqual(attri_index.cross_counts(['name', 'size']),
+                         ([['a', 1], ['b', 1]], [1, 1]))
+        self.assertEqual(attri_index.positions(['i4', 'i1', 'i9']), [0, 3])
+        self.assertEqual(attri_index.to_dict([2, 3]), {'i3': {'name': 'a', 'size': None},
+                                                       'i4': {'name': 'b', 'size': 1}})
+
+    def test_fetch_attributes_columns(self):
+        self.start_test()
+        params = {'matrix_ref': self.expression_matrix_ref,
+                  'ids': ['a', 'test_instance_2', 'test_instance_1'],
+                  'dimension': 'row',
+                  'format': 'columns'}
+        returnVal = self.serviceImpl.fetch_attributes(self.ctx, params)[0]
+
+        self.assertNotIn('attributes', returnVal)
+        expected_columns = {'ids': ['test_instance_1', 'test_instance_2'],
+                            'attributes': ['test_attribute_1', 'test_attribute_2',
+                                           'test_attribute_3'],
+                            'values': [['1-1', '2-1'], ['1-2', '1-2'], ['1-3', '2-3']]}
+        self.assertEqual(returnVal['attribute_columns'], expected_columns)
+
+        params['format'] = 'rows'
+        with self.assertRaisesRegex(ValueError, 'Unknown attribute format rows'):
+            self.serviceImpl.fetch_attributes(self.ctx, params)
+
+    def test_count_attribute_values(self):
+        self.start_test()
+        params = {'matrix_ref': self.expression_matrix_ref,
+                  'attribute_names': ['test_attribute_1', 'test_attribute_3'],
+                  'row_attribute_query': {'test_attribute_2': ['1-2']},
+                  'cross_tabulations': [['test_attribute_2', 'test_attribute_3']]}
+        returnVal = self.serviceImpl.count_attribute_values(self.ctx, params)[0]
+
+        self.assertEqual(returnVal['instance_count'], 2)
+        self.assertEqual(returnVal['attributes_counts'],
+                         {'test_attribute_1': {'1-1': 1, '2-1': 1},
+                          'test_attribute_3': {'1-3': 1, '2-3': 1}})
+        self.assertEqual(returnVal['cross_tabulations'],
+                         [{'attributes': ['test_attribute_2', 'test_attribute_3'],
+                           'values': [['1-2', '1-3'], ['1-2', '2-3']],
+                           'counts': [1, 1]}])
+
+        params = {'matrix_ref': self.expression_matrix_ref,
+                  'attribute_names': ['test_attribute_2']}
+        returnVal = self.serviceImpl.count_attribute_values(self.ctx, params)[0]
+        self.assertEqual(returnVal['instance_count'], 3)
+        self.assertEqual(returnVal['attributes_counts'],
+                         {'test_attribute_2': {'1-2': 2, '3-2': 1}})
+
+        params['attribute_names'] = ['test_attribute_4']
+        with self.assertRaisesRegex(ValueError, 'Cannot find test_attribute_4'):
+            self.serviceImpl.count_attribute_values(self.ctx, params)
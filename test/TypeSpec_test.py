@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from GenericsService.TypeSpec import GenericsTypeCache, SpecModel, tokenize
+
+GENERICS_TYPES = ['FloatMatrix2D', 'StringMatrix2D']
+
+MATRIX_SPEC = '''
+#include <KBaseFBA.spec>
+#include <KBaseExperiments.spec>
+
+/*
+ * A matrix module.  typedef structure { int commented_out; } NotAType;
+ */
+module KBaseMatrices {
+    /* @id ws KBaseExperiments.AttributeMapping */
+    typedef string attributemapping_ref;
+
+    typedef KBaseFBA.FloatMatrix2D FloatMatrix2D;
+    typedef FloatMatrix2D Values;  // a chain of aliases
+    typedef Values LevelValues;
+
+    /*
+     * @optional row_mapping col_mapping
+     */
+    typedef structure {
+        string scale;
+        attributemapping_ref row_attributemapping_ref;
+        mapping<string, string> row_mapping;
+        mapping<string, string> col_mapping;
+        LevelValues data;
+    } ExpressionMatrix;
+
+    typedef structure {
+        list<tuple<string id, FloatMatrix2D values>> matrices;
+        mapping<string, list<KBaseFBA.StringMatrix2D>> labels;
+        int count;
+    } MatrixSet;
+
+    funcdef count_matrices(ExpressionMatrix params) returns (int count) authentication required;
+};
+'''
+
+
+class TypeSpecTest(unittest.TestCase):
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize('typedef mapping<string, int> /* ids */ Ids; // counts\n'),
+                         ['typedef', 'mapping', '<', 'string', ',', 'int', '>', 'Ids', ';'])
+        self.assertEqual(tokenize('typedef KBaseFBA.FloatMatrix2D M;'),
+                         ['typedef', 'KBaseFBA.FloatMatrix2D', 'M', ';'])
+        self.assertEqual(tokenize('#include <KBaseFBA.spec>\ntypedef int Count;'),
+                         ['typedef', 'int', 'Count', ';'])
+
+    def test_typedefs(self):
+        spec_model = SpecModel(MATRIX_SPEC)
+        # the #include lines and the typedef in the module comment are not parsed, the
+        # funcdef is skipped
+        self.assertNotIn('NotAType', spec_model.typedefs)
+        self.assertNotIn('count_matrices', spec_model.typedefs)
+
+        self.assertEqual(spec_model.typedefs['FloatMatrix2D'], ('name', 'KBaseFBA.FloatMatrix2D'))
+        self.assertEqual(spec_model.typedefs['MatrixSet'], ('structure', [
+            ('matrices', ('list', ('tuple', [('name', 'string'), ('name', 'FloatMatrix2D')]))),
+            ('labels', ('mapping', ('name', 'string'),
+                        ('list', ('name', 'KBaseFBA.StringMatrix2D')))),
+            ('count', ('name', 'int'))]))
+
+    def test_find_generics_fields(self):
+        spec_model = SpecModel(MATRIX_SPEC)
+        # the data field is found through the chain of aliases to a type of another module
+        self.assertEqual(spec_model.find_generics_fields('ExpressionMatrix', GENERICS_TYPES),
+                         {'data': 'FloatMatrix2D'})
+        self.assertEqual(spec_model.find_generics_fields('MatrixSet', GENERICS_TYPES),
+                         {'matrices': 'FloatMatrix2D', 'labels': 'StringMatrix2D'})
+        with self.assertRaises(ValueError):
+            spec_model.find_generics_fields('Values', GENERICS_TYPES)
+
+    def test_unresolved_names(self):
+        # the spec of a single type refers to the typedefs of its module it uses
+        type_spec = '''
+            typedef structure {
+                string scale;
+                LevelValues data;
+                KBaseFBA.FloatMatrix2D other_data;
+            } ExpressionMatrix;
+        '''
+        spec_model = SpecModel(type_spec)
+        self.assertEqual(spec_model.unresolved_names('ExpressionMatrix'), {'LevelValues'})
+        self.assertEqual(spec_model.find_generics_fields('ExpressionMatrix', GENERICS_TYPES),
+                         {'other_data': 'FloatMatrix2D'})
+        self.assertEqual(SpecModel(MATRIX_SPEC).unresolved_names('ExpressionMatrix'), set())
+
+    def test_invalid_spec(self):
+        with self.assertRaises(ValueError):
+            SpecModel('typedef structure { string name; ')
+        with self.assertRaises(ValueError):
+            SpecModel('typedef list<string> > Names;')
+
+
+class GenericsTypeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_get_add(self):
+        type_cache = GenericsTypeCache()
+        self.assertIsNone(type_cache.get('KBaseMatrices.ExpressionMatrix-1.2'))
+        type_cache.add('KBaseMatrices.ExpressionMatrix-1.2', {'data': 'FloatMatrix2D'})
+
+        generics_module = type_cache.get('KBaseMatrices.ExpressionMatrix-1.2')
+        self.assertEqual(generics_module, {'data': 'FloatMatrix2D'})
+        # callers get a copy of the cached value
+        generics_module['other'] = 'StringMatrix2D'
+        self.assertEqual(type_cache.get('KBaseMatrices.ExpressionMatrix-1.2'),
+                         {'data': 'FloatMatrix2D'})
+
+        stats = type_cache.stats()
+        self.assertEqual((stats['entries'], stats['hits'], stats['misses']), (1, 2, 1))
+
+    def test_versions(self):
+        type_cache = GenericsTypeCache()
+        # types without a full version can resolve to a newer spec at any time
+        for obj_type in ('KBaseMatrices.ExpressionMatrix', 'KBaseMatrices.ExpressionMatrix-1'):
+            type_cache.add(obj_type, {'data': 'FloatMatrix2D'})
+            self.assertIsNone(type_cache.get(obj_type))
+        type_cache.add('KBaseMatrices.ExpressionMatrix-1.2', {'data': 'FloatMatrix2D'})
+        self.assertIsNone(type_cache.get('KBaseMatrices.ExpressionMatrix-1.3'))
+
+        spec_model = SpecModel(MATRIX_SPEC)
+        type_cache.add_module_model('KBaseMatrices', 1, spec_model)
+        self.assertIs(type_cache.get_module_model('KBaseMatrices', 1), spec_model)
+        self.assertIsNone(type_cache.get_module_model('KBaseMatrices', 2))
+
+    def test_persisted_file(self):
+        cache_file = os.path.join(self.directory, 'type_cache.json')
+        type_cache = GenericsTypeCache(cache_file)
+        type_cache.add('KBaseMatrices.ExpressionMatrix-1.2', {'data': 'FloatMatrix2D'})
+        with open(cache_file) as f:
+            self.assertEqual(json.load(f),
+                             {'KBaseMatrices.ExpressionMatrix-1.2': {'data': 'FloatMatrix2D'}})
+
+        # a restarted server loads the cache
+        type_cache = GenericsTypeCache(cache_file)
+        self.assertEqual(type_cache.get('KBaseMatrices.ExpressionMatrix-1.2'),
+                         {'data': 'FloatMatrix2D'})
+
+        # a damaged file is ignored
+        with open(cache_file, 'w') as f:
+            f.write('{"KBaseMatrices.Expr')
+        type_cache = GenericsTypeCache(cache_file)
+        self.assertIsNone(type_cache.get('KBaseMatrices.ExpressionMatrix-1.2'))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+from unittest import mock
+
+from installed_clients import authclient
+from installed_clients.authclient import KBaseAuth, TokenCache
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.reason = 'OK' if self.ok else 'Unauthorized'
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class AuthClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(authclient, '_time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def mock_auth_service(self, response, delay=0):
+        calls = list()
+
+        def post(url, data):
+            calls.append(data['token'])
+            time.sleep(delay)
+            return response
+
+        patcher = mock.patch.object(authclient, '_post', post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    def test_token_cache_eviction(self):
+        cache = TokenCache(maxsize=3, stripes=1)
+        for i in range(3):
+            cache.add_valid_token('token_{}'.format(i), 'user_{}'.format(i))
+        # token_0 is used last, token_1 is the least recently used
+        self.assertEqual(cache.get_user('token_0'), 'user_0')
+        cache.add_valid_token('token_3', 'user_3')
+
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get_user('token_1'))
+        for i in (0, 2, 3):
+            self.assertEqual(cache.get_user('token_{}'.format(i)), 'user_{}'.format(i))
+
+    def test_token_cache_expiry(self):
+        cache = TokenCache()
+        cache.add_valid_token('token', 'user')
+        self.clock.now += TokenCache._MAX_TIME_SEC - 1
+        self.assertEqual(cache.get_user('token'), 'user')
+        self.clock.now += 2
+        self.assertIsNone(cache.lookup('token'))
+        self.assertEqual(len(cache), 0)
+
+    def test_get_user_caches_user(self):
+        calls = self.mock_auth_service(FakeResponse(200, {'user_id': 'user'}))
+        auth = KBaseAuth('https://auth')
+        self.assertEqual(auth.get_user('token'), 'user')
+        self.assertEqual(auth.get_user('token'), 'user')
+        self.assertEqual(calls, ['token'])
+
+    def test_get_user_caches_rejected_token(self):
+        calls = self.mock_auth_service(FakeResponse(401, {'error': {'message': 'Invalid token'}}))
+        auth = KBaseAuth('https://auth')
+        for _ in range(3):
+            with self.assertRaisesRegex(ValueError, 'Invalid token'):
+                auth.get_user('bad_token')
+        self.assertEqual(len(calls), 1)
+
+        # a rejected token is asked again once its entry expires
+        self.clock.now += TokenCache._REJECTED_TIME_SEC + 1
+        with self.assertRaisesRegex(ValueError, 'Invalid token'):
+            auth.get_user('bad_token')
+        self.assertEqual(len(calls), 2)
+
+    def test_get_user_does_not_cache_service_errors(self):
+        # only 401 and 403 mean the token is bad, e.g. a rate limit is not about the token
+        for status_code in (400, 404, 429, 503):
+            calls = self.mock_auth_service(FakeResponse(status_code,
+                                                        {'error': {'message': 'Unavailable'}}))
+            auth = KBaseAuth('https://auth')
+            for _ in range(2):
+                with self.assertRaisesRegex(ValueError, 'Unavailable'):
+                    auth.get_user('token')
+            self.assertEqual(len(calls), 2)
+
+    def test_concurrent_get_user(self):
+        calls = self.mock_auth_service(FakeResponse(200, {'user_id': 'user'}), delay=0.2)
+        auth = KBaseAuth('https://auth')
+        users = list()
+
+        def get_user():
+            users.append(auth.get_user('token'))
+
+        threads = [threading.Thread(target=get_user) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(users, ['user'] * 10)
+        self.assertEqual(calls, ['token'])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+'''
+Micro-benchmark of the auth client token cache, run with lib on the python path:
+
+    PYTHONPATH=lib python test/benchmark_token_cache.py [entries ...]
+
+Reports lookups and adds per second in a single thread, the slowest add while the cache is
+full, and the auth service calls made by concurrent get_user calls with one token.
+'''
+import sys
+import threading
+import time
+
+from installed_clients import authclient
+from installed_clients.authclient import KBaseAuth, TokenCache
+
+OPERATIONS = 200000
+
+
+def rates(entries, operations=OPERATIONS):
+    cache = TokenCache(maxsize=entries)
+    tokens = ['token_{}'.format(i) for i in range(entries)]
+    for token in tokens:
+        cache.add_valid_token(token, 'user')
+
+    start = time.perf_counter()
+    for i in range(operations):
+        cache.get_user(tokens[i % entries])
+    get_rate = operations / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(operations):
+        cache.add_valid_token('new_token_{}'.format(i), 'user')
+    add_rate = operations / (time.perf_counter() - start)
+    return get_rate, add_rate
+
+
+def worst_add(entries):
+    cache = TokenCache(maxsize=entries)
+    worst = 0
+    for i in range(3 * entries):
+        start = time.perf_counter()
+        cache.add_valid_token('token_{}'.format(i), 'user')
+        worst = max(worst, time.perf_counter() - start)
+    return worst
+
+
+class FakeAuthService(object):
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.calls = 0
+
+    def post(self, url, data):
+        self.calls += 1
+        time.sleep(self.delay)
+        return self
+
+    ok = True
+
+    @staticmethod
+    def json():
+        return {'user_id': 'user'}
+
+
+def concurrent_auth_calls(threads=20):
+    service = FakeAuthService()
+    authclient._post = service.post
+    auth = KBaseAuth('https://auth')
+    workers = [threading.Thread(target=auth.get_user, args=('token',)) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return service.calls
+
+
+def main(sizes):
+    print('entries    get/s    add/s  worst add')
+    for entries in sizes:
+        get_rate, add_rate = rates(entries)
+        print('{:>7} {:>7.0f}k {:>7.0f}k {:>8.2f}ms'.format(
+            entries, get_rate / 1000, add_rate / 1000, worst_add(entries) * 1000))
+    print('20 concurrent get_user calls with one token: {} auth service calls'.format(
+        concurrent_auth_calls()))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [2000, 200000])